@@ -0,0 +1,164 @@
+"""
+Benchmarks the raster-to-mask pipeline on synthetic scenes, so that it can be timed without real Sentinel-1 data.
+
+A georeferenced GLCM .data folder and a land-water classified mask are generated in a temporary directory, with the
+reduced Lake Texana outline as the reservoir and random noise on top. Every stage is then timed and a JSON report is
+written for regression tracking.
+
+Run from the repository root, e.g.
+    python benchmarks/benchmark_pipeline.py --height 1200 --width 900 --repeat 3 --output bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# Same source roots as the IDE setup the other scripts rely on
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for source_root in (repo_dir, os.path.join(repo_dir, 'sar_machine_learning'), os.path.join(repo_dir, 'datacleaning')):
+    if source_root not in sys.path:
+        sys.path.insert(0, source_root)
+
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.features import rasterize
+from rasterio.transform import from_bounds
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+
+import basicconfig as config
+import trainingdata
+from land_water_classification import predict_to_mask
+from reservoir_area import get_reservoir_area, get_shoreline_length
+from water_mask import find_reservoir_seed, extract_reservoir, write_mask, get_reservoir_wkt, \
+    count_reservoir_pixels
+
+GLCM_FEATURES = ['Mean', 'Variance', 'Contrast', 'Dissimilarity', 'Homogeneity', 'ASM', 'Energy', 'MAX', 'Entropy',
+                 'Correlation']
+
+
+def get_scene_grid(height, width):
+    """Returns the transform of a height x width grid covering the Lake Texana AOI"""
+    west, south, east, north = trainingdata.convert_wkt_to_polygon(config.TEXANA_WKT).bounds
+    return from_bounds(west, south, east, north, width, height)
+
+
+def get_reservoir_mask(height, width, transform):
+    reservoir = trainingdata.convert_wkt_to_polygon(config.TEXANA_WKT_REDUCED)
+    return rasterize([reservoir], out_shape=(height, width), transform=transform, all_touched=True).astype(bool)
+
+
+def create_glcm_folder(path, water, transform, num_bands, rng):
+    """Writes one ENVI .img per GLCM band, with darker and smoother water than land"""
+    os.makedirs(path, exist_ok=True)
+    height, width = water.shape
+    for band_idx, feature in enumerate(GLCM_FEATURES[:num_bands]):
+        band_name = f'Sigma0_{config.POLARIZATIONS}_GLCM{feature}'
+        arr = np.where(water, 0.2, 0.6) * (band_idx + 1) + rng.normal(0, 0.1, size=(height, width))
+        with rasterio.open(os.path.join(path, band_name + '.img'), 'w', driver='ENVI', height=height, width=width,
+                           count=1, dtype=np.float32, crs='EPSG:4326', transform=transform) as dst:
+            dst.write(arr.astype(np.float32), 1)
+            dst.set_band_description(1, band_name)
+
+
+def create_classified_mask(water, noise_ratio, rng):
+    """Land-water classified image as written by land_water_classification.py, with salt and pepper noise"""
+    flip = rng.random(water.shape) < noise_ratio
+    return np.where(water ^ flip, config.BLACK, config.WHITE).astype(np.uint8)
+
+
+def time_stage(func, repeat):
+    runs = []
+    result = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        runs.append(time.perf_counter() - start)
+    return result, {'min_s': min(runs), 'mean_s': float(np.mean(runs)), 'runs_s': runs}
+
+
+def run_benchmark(work_dir, height, width, num_bands, num_trees, noise_ratio, repeat, seed):
+    rng = np.random.default_rng(seed)
+    transform = get_scene_grid(height, width)
+    water = get_reservoir_mask(height, width, transform)
+    folder = os.path.join(work_dir, f'S1A_IW_GRDH_1SDV_20190101T000000_glcm_{config.POLARIZATIONS}.data')
+    create_glcm_folder(folder, water, transform, num_bands, rng)
+    classified = create_classified_mask(water, noise_ratio, rng)
+
+    stages = {}
+
+    def label():
+        trainingdata._window_index_cache.clear()
+        return trainingdata.get_labelled_features_as_df(folder)
+
+    features, stages['feature_extraction'] = time_stage(lambda: trainingdata.extract_features_from(folder), repeat)
+    del features
+    feature_df, stages['labelling'] = time_stage(label, repeat)
+
+    def fit():
+        pipeline = Pipeline([('transformer', StandardScaler()),
+                             ('estimator', RandomForestClassifier(n_estimators=num_trees, random_state=seed))])
+        return pipeline.fit(feature_df.iloc[:, :-1], feature_df['label'])
+
+    pipeline, stages['fit'] = time_stage(fit, repeat)
+    out_path = os.path.join(work_dir, 'land_water_mask_rf_20190101T000000_VV.tif')
+    _, stages['predict'] = time_stage(lambda: predict_to_mask(pipeline.named_steps['estimator'],
+                                                              pipeline.named_steps['transformer'],
+                                                              folder, out_path), repeat)
+
+    seed_point, stages['reservoir_detection'] = time_stage(lambda: find_reservoir_seed(classified), repeat)
+    if seed_point is None:
+        raise RuntimeError("No reservoir was found in the synthetic mask, increase the scene size")
+    reservoir, stages['reservoir_extraction'] = time_stage(lambda: extract_reservoir(classified, seed_point), repeat)
+    msk_arr = np.where(reservoir, config.RESERVOIR_COLOR, config.BLACK).astype(np.uint8)
+
+    _, stages['vectorisation'] = time_stage(lambda: get_reservoir_wkt(msk_arr, transform), repeat)
+    mask_path = os.path.join(work_dir, '20190101_VV.tif')
+    _, stages['mask_write'] = time_stage(lambda: write_mask(mask_path, msk_arr, 'EPSG:4326', transform), repeat)
+    crs = CRS.from_epsg(4326)
+    area, stages['area'] = time_stage(lambda: get_reservoir_area(msk_arr, transform, crs), repeat)
+    shoreline_length, stages['shoreline'] = time_stage(lambda: get_shoreline_length(msk_arr, transform, crs), repeat)
+
+    return {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'parameters': {'height': height, 'width': width, 'bands': num_bands, 'trees': num_trees,
+                       'noise_ratio': noise_ratio, 'repeat': repeat, 'seed': seed},
+        'results': {'labelled_samples': int(len(feature_df)), 'reservoir_pixels': count_reservoir_pixels(msk_arr),
+                    'reservoir_area_m2': area, 'shoreline_length_m': shoreline_length},
+        'stages': stages,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--height', type=int, default=1850, help='rows of the synthetic scene')
+    parser.add_argument('--width', type=int, default=1450, help='columns of the synthetic scene')
+    parser.add_argument('--bands', type=int, default=len(GLCM_FEATURES), choices=range(1, len(GLCM_FEATURES) + 1),
+                        metavar='BANDS', help='number of GLCM bands (1-10)')
+    parser.add_argument('--trees', type=int, default=100, help='number of trees of the random forest')
+    parser.add_argument('--noise', type=float, default=0.02, help='ratio of misclassified pixels in the mask')
+    parser.add_argument('--repeat', type=int, default=1, help='number of timed runs of every stage')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', help='directory for the synthetic data (a temporary directory by default)')
+    parser.add_argument('--output', help='path of the JSON report (printed to stdout by default)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        report = run_benchmark(args.work_dir or tmp_dir, args.height, args.width, args.bands, args.trees, args.noise,
+                               args.repeat, args.seed)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
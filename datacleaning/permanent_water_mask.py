@@ -1,9 +1,9 @@
 import logging
 import os
 import re
-import sys
 
-from trainingdata import convert_wkt_to_polygon
+from water_mask import read_aoi, find_reservoir_seed, extract_reservoir, write_mask, get_reservoir_wkt, \
+    update_scene_json
 
 logging.basicConfig(
     format='%(asctime)s %(levelname)-8s %(name)s: %(message)s',
@@ -11,13 +11,8 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S')
 logger = logging.getLogger(__name__)
 
-from PIL import Image, ImageDraw
 import rasterio
 import numpy as np
-import json
-from rasterio import mask
-from rasterio.features import shapes
-from shapely.geometry import shape
 import filemanager
 import platform
 import basicconfig as config
@@ -35,89 +30,52 @@ classified_LC_dir = config.GRD_PARENT_DIR + "Processing_2020\\" + config.LC_CLAS
 
 
 
-def is_area_larger_than(image, i, j, iterations, thres):
-    curr_area = 0
-    for p_x in range(i, min(i + iterations, height)):
-        for p_y in range(j, min(j + iterations, width)):
-            if image[p_x][p_y] == config.BLACK:
-                curr_area += 1
-    logger.debug("area is {}".format(curr_area))
-    if curr_area > thres:
-        return True
-    return False
+# The mask GTiffs are optional, data.json is vectorised from the in-memory masks
+write_mask_tifs = True
+# Number of scenes processed in parallel (None uses all cores)
+num_workers = None
+# Only process the classified images that are new or modified since the last run and merge them into data.json
+incremental = True
+loop_dir = classified_LC_dir
 
 
-sample_spacing = 70
-area_threshold = 0.96 * sample_spacing * sample_spacing
-mask_json = {}
-loop_dir = classified_LC_dir
-accuracy = []
-for folder in os.listdir(loop_dir):
+def get_mask_path(key):
+    return mask_dir + key + '.tif'
+
+
+def process_scene(folder):
+    """Extracts the reservoir of one classified image. Returns its data.json key and the WKT of the reservoir"""
     logger.info(folder)
-    img = rasterio.open(loop_dir + folder)
-    LC_polygon = convert_wkt_to_polygon(config.LC_WKT_REDUCED)
-    [prdt_arr], prdt_xy = mask.mask(dataset=img, shapes=[LC_polygon], nodata=config.NO_DATA, all_touched=True, crop=True)
-    # msk = Image.open(loop_dir + folder)
-    msk = Image.fromarray(prdt_arr)
-    msk.show()
-
-    width, height = prdt_arr.shape[1], prdt_arr.shape[0]
+    with rasterio.open(loop_dir + folder) as img:
+        prdt_arr, prdt_xy = read_aoi(img, config.LC_WKT_REDUCED)
+        crs = img.crs
+
     binary_img = prdt_arr
     logger.info(binary_img.shape)
-    done = False
-    # To reduce unnecessary checking, we starting search for the reservoir at an arbitrary point
-    for x in range(0, height, sample_spacing // 2):
-        for y in range(0, width, sample_spacing // 2):
-            if binary_img[x][y] == config.BLACK:
-                if is_area_larger_than(binary_img, x, y, sample_spacing, area_threshold) and is_area_larger_than(binary_img, x + sample_spacing // 2, y, sample_spacing, area_threshold):
-                    logger.info("Found the reservoir!")
-                    ImageDraw.floodfill(msk, (y, x), config.RESERVOIR_COLOR)
-                    done = True
-                    break
-        if done:
-            break
-    if not done:
-        logger.critical("No reservoir was found.")
-        sys.exit("No reservoir was found.")
-    msk_arr = np.array(msk).astype(np.uint8)
-    msk_arr[msk_arr == config.WHITE] = config.BLACK
-    msk_arr[msk_arr == config.NO_DATA] = config.BLACK
-    msk_arr[msk_arr == config.WATER] = config.RESERVOIR_COLOR
-
+    seed = find_reservoir_seed(binary_img)
+    if seed is None:
+        raise ValueError("No reservoir was found.")
+    logger.info("Found the reservoir!")
+    msk_arr = np.where(extract_reservoir(prdt_arr, seed), config.RESERVOIR_COLOR, config.BLACK).astype(np.uint8)
 
     file_name = re.sub("\\..*$", "", folder)
     date = file_name.split('_')[-2][:8]
-    mask_prdt_path = mask_dir + date + f'_{config.POLARIZATIONS}' + '.tif'
-    with rasterio.open(
-        mask_prdt_path,
-        'w',
-        driver='GTiff',
-        height=height,
-        width=width,
-        count=1,
-        dtype=np.uint8,
-        nodata=config.BLACK,
-        crs=img.crs,
-        transform=img.transform,
-    ) as dst:
-        dst.write(msk_arr, 1)
-
-    with rasterio.open(mask_prdt_path, 'r') as src:
-        image = src.read(1, masked=True)  # first band
-        results = (
-            {'properties': {'raster_val': v}, 'geometry': s}
-            for i, (s, v) in enumerate(shapes(image, mask=None, transform=src.transform)))
-    geoms = list(results)
-    shp = shape(geoms[0]['geometry'])
-    mask_json[date + f'_{config.POLARIZATIONS}'] = str(shp)
-
-with open(mask_dir + 'data.json', 'w', encoding='utf-8') as f:
-    json.dump(mask_json, f, ensure_ascii=False, indent=4)
-logger.info("Completed")
-
-if platform.system() == "Windows":
-    import winsound
-    duration = 1000  # milliseconds
-    freq = 1000  # Hz
-    winsound.Beep(freq, duration)
-    winsound.Beep(freq, duration)
\ No newline at end of file
+    key = date + f'_{config.POLARIZATIONS}'
+    if write_mask_tifs:
+        write_mask(get_mask_path(key), msk_arr, crs, prdt_xy)
+    return key, get_reservoir_wkt(msk_arr, prdt_xy)
+
+
+if __name__ == '__main__':
+    settings = {'aoi': config.LC_WKT_REDUCED, 'polarizations': config.POLARIZATIONS,
+                'write_mask_tifs': write_mask_tifs}
+    update_scene_json(process_scene, loop_dir, sorted(os.listdir(loop_dir)), mask_dir + 'data.json', num_workers,
+                      incremental, settings, get_mask_path if write_mask_tifs else None)
+    logger.info("Completed")
+
+    if platform.system() == "Windows":
+        import winsound
+        duration = 1000  # milliseconds
+        freq = 1000  # Hz
+        winsound.Beep(freq, duration)
+        winsound.Beep(freq, duration)
\ No newline at end of file
@@ -0,0 +1,74 @@
+import logging
+import os
+import re
+
+from reservoir_area import get_reservoir_area, get_shoreline_length
+from water_mask import read_aoi, find_reservoir_seed, extract_reservoir, write_mask, update_scene_json
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(name)s: %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+import rasterio
+import numpy as np
+import filemanager
+import platform
+import basicconfig as config
+
+
+input_dir, output_dir = filemanager.get_file_paths_based_on_os(platform.system(), filemanager.Product.grd)
+area_dir = config.GRD_PARENT_DIR + "Processing_2020\\Area\\"
+classified_LC_dir = config.GRD_PARENT_DIR + "Processing_2020\\" + config.LC_CLASSIFIED_DIR
+
+
+# Number of scenes processed in parallel (None uses all cores)
+num_workers = None
+# Only process the classified images that are new or modified since the last run and merge them into area.json
+incremental = True
+# Store {"area": ..., "shoreline_length": ...} per scene instead of only the area
+report_shoreline = False
+loop_dir = classified_LC_dir
+
+
+def get_mask_path(key):
+    return area_dir + key + '.tif'
+
+
+def process_scene(folder):
+    """Extracts the reservoir of one classified image. Returns its area.json key and the reservoir area"""
+    logger.info(folder)
+    file_name = re.sub("\\..*$", "", folder)
+    date = file_name.split('_')[-2][:8]
+    with rasterio.open(loop_dir + folder) as img:
+        prdt_arr, prdt_xy = read_aoi(img, config.LC_WKT_REDUCED)
+        crs = img.crs
+
+    seed = find_reservoir_seed(prdt_arr)
+    if seed is None:
+        raise ValueError("No reservoir was found.")
+    msk_arr = np.where(extract_reservoir(prdt_arr, seed), config.RESERVOIR_COLOR, config.BLACK).astype(np.uint8)
+    area = get_reservoir_area(msk_arr, prdt_xy, crs)
+
+    key = date + f'_{config.POLARIZATIONS}'
+    write_mask(get_mask_path(key), msk_arr, crs, prdt_xy)
+    if report_shoreline:
+        shoreline_length = get_shoreline_length(msk_arr, prdt_xy, crs)
+        return key, {'area': int(area), 'shoreline_length': int(shoreline_length)}
+    return key, int(area)
+
+
+if __name__ == '__main__':
+    settings = {'aoi': config.LC_WKT_REDUCED, 'polarizations': config.POLARIZATIONS,
+                'report_shoreline': report_shoreline}
+    update_scene_json(process_scene, loop_dir, sorted(os.listdir(loop_dir)), area_dir + 'area.json', num_workers,
+                      incremental, settings, get_mask_path)
+    logger.info("Completed")
+
+    if platform.system() == "Windows":
+        import winsound
+        duration = 1000  # milliseconds
+        freq = 1000  # Hz
+        winsound.Beep(freq, duration)
+        winsound.Beep(freq, duration)
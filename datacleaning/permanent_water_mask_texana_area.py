@@ -7,7 +7,8 @@ import pyproj
 from shapely.ops import transform
 from skimage.morphology import remove_small_holes, remove_small_objects
 
-from trainingdata import convert_wkt_to_polygon
+from reservoir_area import get_reservoir_area, get_shoreline_length
+from water_mask import read_aoi, write_mask, update_scene_json
 
 logging.basicConfig(
     format='%(asctime)s %(levelname)-8s %(name)s: %(message)s',
@@ -17,8 +18,6 @@ logger = logging.getLogger(__name__)
 
 import rasterio
 import numpy as np
-import json
-from rasterio import mask
 from shapely.wkt import loads
 import filemanager
 import platform
@@ -36,17 +35,30 @@ def convert_wkt_from_dd_to_m_to_polygon(wkt_in):
     return transform(projection, wkt)
 
 
-areas_json = {}
-mask_json = {}
+# Number of scenes processed in parallel (None uses all cores)
+num_workers = None
+# Only process the classified images that are new or modified since the last run and merge them into area.json
+incremental = True
+# Store {"area": ..., "shoreline_length": ...} per scene instead of only the area
+report_shoreline = False
+# Holes of the water smaller than this number of pixels are filled and water bodies smaller than this are removed
+hole_area_threshold = 2048
+min_object_size = 1024
 loop_dir = classified_LC_dir
-sorted_files = sorted(os.listdir(loop_dir))
-for folder in sorted_files:
+
+
+def get_mask_path(key):
+    return area_dir + key + '.tif'
+
+
+def process_scene(folder):
+    """Cleans the water pixels of one classified image. Returns its area.json key and the reservoir area"""
     logger.info(folder)
-    img = rasterio.open(loop_dir + folder)
     file_name = re.sub("\\..*$", "", folder)
     date = file_name.split('_')[-2][:8]
-    LC_polygon = convert_wkt_to_polygon(config.TEXANA_WKT_REDUCED)
-    [prdt_arr], prdt_xy = mask.mask(dataset=img, shapes=[LC_polygon], nodata=config.NO_DATA, all_touched=True, crop=True)
+    with rasterio.open(loop_dir + folder) as img:
+        prdt_arr, prdt_xy = read_aoi(img, config.TEXANA_WKT_REDUCED)
+        crs = img.crs
 
     height, width = prdt_arr.shape
     binary_img = prdt_arr
@@ -56,42 +68,32 @@ for folder in sorted_files:
     msk_arr[msk_arr == config.NO_DATA] = config.LAND
     msk_arr[msk_arr == config.WHITE] = config.LAND
     bool_msk = msk_arr > 0
-    msk_arr = remove_small_holes(bool_msk, area_threshold=2048).astype(np.uint8)
+    msk_arr = remove_small_holes(bool_msk, area_threshold=hole_area_threshold).astype(np.uint8)
 
     bool_msk = msk_arr > 0
-    msk_arr = remove_small_objects(bool_msk, min_size=1024).astype(np.uint8)
+    msk_arr = remove_small_objects(bool_msk, min_size=min_object_size).astype(np.uint8)
     msk_arr[msk_arr == config.WATER] = config.RESERVOIR_COLOR
-    msk_arr_flatten = msk_arr.flatten()
-    unique, counts = np.unique(msk_arr_flatten, return_counts=True)
-
-    count_dict = dict(zip(unique, counts))
-    num_water_pixels = count_dict[config.RESERVOIR_COLOR]
-    area = num_water_pixels * 100
-
-    mask_prdt_path = area_dir + date + f'_{config.POLARIZATIONS}' + '.tif'
-    with rasterio.open(
-        mask_prdt_path,
-        'w',
-        driver='GTiff',
-        height=img.height,
-        width=img.width,
-        count=1,
-        dtype=np.uint8,
-        nodata=config.BLACK,
-        crs=img.crs,
-        transform=img.transform,
-    ) as dst:
-        dst.write(msk_arr, 1)
-
-    areas_json[date + f'_{config.POLARIZATIONS}'] = int(area)
-
-with open(area_dir + 'area.json', 'w', encoding='utf-8') as f:
-    json.dump(areas_json, f, ensure_ascii=False, indent=4)
-logger.info("Completed")
-
-if platform.system() == "Windows":
-    import winsound
-    duration = 1000  # milliseconds
-    freq = 1000  # Hz
-    winsound.Beep(freq, duration)
-    winsound.Beep(freq, duration)
\ No newline at end of file
+    area = get_reservoir_area(msk_arr, prdt_xy, crs)
+
+    key = date + f'_{config.POLARIZATIONS}'
+    write_mask(get_mask_path(key), msk_arr, crs, prdt_xy)
+    if report_shoreline:
+        shoreline_length = get_shoreline_length(msk_arr, prdt_xy, crs)
+        return key, {'area': int(area), 'shoreline_length': int(shoreline_length)}
+    return key, int(area)
+
+
+if __name__ == '__main__':
+    settings = {'aoi': config.TEXANA_WKT_REDUCED, 'polarizations': config.POLARIZATIONS,
+                'report_shoreline': report_shoreline, 'hole_area_threshold': hole_area_threshold,
+                'min_object_size': min_object_size}
+    update_scene_json(process_scene, loop_dir, sorted(os.listdir(loop_dir)), area_dir + 'area.json', num_workers,
+                      incremental, settings, get_mask_path)
+    logger.info("Completed")
+
+    if platform.system() == "Windows":
+        import winsound
+        duration = 1000  # milliseconds
+        freq = 1000  # Hz
+        winsound.Beep(freq, duration)
+        winsound.Beep(freq, duration)
\ No newline at end of file
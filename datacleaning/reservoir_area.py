@@ -0,0 +1,63 @@
+"""
+Functions for measuring the reservoir in the water masks, using the resolution of the raster instead of a fixed
+pixel size
+"""
+import numpy as np
+from pyproj import Geod
+
+import basicconfig as config
+
+GEOD = Geod(ellps='WGS84')
+
+# Pixel geometry of every raster grid, keyed by the grid
+_pixel_geometry_cache = {}
+
+
+def get_pixel_geometry(transform, crs, height):
+    """
+    Returns the pixel area (m^2) and pixel height (m) of every row, and the pixel width (m) along every row edge
+    (height + 1 edges). For a projected CRS these are constant. For a geographic CRS they are geodesic on the WGS84
+    ellipsoid and vary with the latitude of the row. The grid is assumed to be north up (no rotation).
+    """
+    key = (tuple(transform), str(crs), height)
+    if key in _pixel_geometry_cache:
+        return _pixel_geometry_cache[key]
+
+    if crs is not None and crs.is_geographic:
+        lon = transform.c
+        edge_lats = transform.f + transform.e * np.arange(height + 1)
+        edge_lons = np.full(height + 1, lon)
+        _, _, edge_widths = GEOD.inv(edge_lons, edge_lats, edge_lons + transform.a, edge_lats)
+        _, _, row_heights = GEOD.inv(edge_lons[:-1], edge_lats[:-1], edge_lons[1:], edge_lats[1:])
+        row_areas = np.empty(height)
+        for row in range(height):
+            top, bottom = edge_lats[row], edge_lats[row + 1]
+            area, perimeter = GEOD.polygon_area_perimeter([lon, lon + transform.a, lon + transform.a, lon],
+                                                          [top, top, bottom, bottom])
+            row_areas[row] = abs(area)
+        geometry = (row_areas, np.asarray(row_heights), np.asarray(edge_widths))
+    else:
+        unit_factor = crs.linear_units_factor[1] if crs is not None else 1.0
+        pixel_width, pixel_height = abs(transform.a) * unit_factor, abs(transform.e) * unit_factor
+        geometry = (np.full(height, pixel_width * pixel_height), np.full(height, pixel_height),
+                    np.full(height + 1, pixel_width))
+    _pixel_geometry_cache[key] = geometry
+    return geometry
+
+
+def get_reservoir_area(msk_arr, transform, crs):
+    """Area (m^2) of the RESERVOIR_COLOR pixels, counted per row in a single pass"""
+    row_areas, row_heights, edge_widths = get_pixel_geometry(transform, crs, msk_arr.shape[0])
+    row_counts = np.count_nonzero(msk_arr == config.RESERVOIR_COLOR, axis=1)
+    return float(row_counts @ row_areas)
+
+
+def get_shoreline_length(msk_arr, transform, crs):
+    """Length (m) of the pixel edges between the reservoir and everything else, including the edge of the image"""
+    row_areas, row_heights, edge_widths = get_pixel_geometry(transform, crs, msk_arr.shape[0])
+    padded = np.pad(msk_arr == config.RESERVOIR_COLOR, 1)
+    # edges between horizontally adjacent pixels have the height of their row
+    vertical_edges = np.count_nonzero(padded[1:-1, 1:] != padded[1:-1, :-1], axis=1)
+    # edges between vertically adjacent pixels have the width of the row edge they lie on
+    horizontal_edges = np.count_nonzero(padded[1:, 1:-1] != padded[:-1, 1:-1], axis=1)
+    return float(vertical_edges @ row_heights + horizontal_edges @ edge_widths)
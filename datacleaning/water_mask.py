@@ -0,0 +1,269 @@
+"""
+Functions for extracting the reservoir from land-water classified images
+"""
+import hashlib
+import json
+import logging
+import os
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+import rasterio
+from rasterio.features import shapes
+from rasterio.mask import raster_geometry_mask
+from scipy import ndimage
+from shapely.geometry import shape
+from shapely.wkt import loads
+
+import basicconfig as config
+
+logger = logging.getLogger(__name__)
+
+# Side (in pixels) of the square window that has to be almost all water for a point to be taken as the reservoir
+SAMPLE_SPACING = 70
+AREA_RATIO = 0.96
+
+# Rasterised AOI masks, keyed by the AOI WKT and the raster grid
+_aoi_mask_cache = {}
+
+
+def get_aoi_mask(raster, wkt):
+    """
+    Rasterises the AOI once per raster grid. Returns the crop window of the AOI, a mask that is True for the pixels of
+    the window lying outside the AOI and the transform of the window
+    """
+    key = (wkt, tuple(raster.transform), raster.height, raster.width)
+    if key not in _aoi_mask_cache:
+        outside, out_transform, window = raster_geometry_mask(raster, [loads(wkt)], all_touched=True, crop=True)
+        _aoi_mask_cache[key] = (window, outside, out_transform)
+    return _aoi_mask_cache[key]
+
+
+def read_aoi(raster, wkt, nodata=config.NO_DATA):
+    """
+    Same as rasterio.mask.mask(raster, [AOI], nodata=nodata, all_touched=True, crop=True) for the first band, but only
+    the window of the AOI is read and the AOI is not rasterised again for every image of the same grid
+    """
+    window, outside, out_transform = get_aoi_mask(raster, wkt)
+    arr = raster.read(1, window=window)
+    arr[outside] = nodata
+    return arr, out_transform
+
+
+def get_summed_area_table(binary_img):
+    """Summed-area table of the BLACK (water) pixels, padded with a leading row and column of zeros"""
+    height, width = binary_img.shape
+    table = np.zeros((height + 1, width + 1), dtype=np.int64)
+    np.cumsum(np.cumsum(binary_img == config.BLACK, axis=0), axis=1, out=table[1:, 1:])
+    return table
+
+
+def count_in_windows(table, rows, cols, size):
+    """Number of water pixels in the size x size windows starting at (rows, cols), clipped at the image edge"""
+    height, width = table.shape[0] - 1, table.shape[1] - 1
+    top, left = np.minimum(rows, height), np.minimum(cols, width)
+    bottom, right = np.minimum(rows + size, height), np.minimum(cols + size, width)
+    return table[bottom, right] - table[top, right] - table[bottom, left] + table[top, left]
+
+
+def find_reservoir_seed(binary_img, sample_spacing=SAMPLE_SPACING, area_ratio=AREA_RATIO):
+    """
+    Returns the (row, col) of a point inside the reservoir, or None if no large enough water body is found.
+    Candidates are the water pixels on a grid of half the sample spacing whose window, and the window half a spacing
+    below, are both almost all water. All candidate windows are counted at once with a summed-area table and the
+    candidate with the most water is returned.
+    """
+    height, width = binary_img.shape
+    area_threshold = area_ratio * sample_spacing * sample_spacing
+    step = sample_spacing // 2
+    rows, cols = np.meshgrid(np.arange(0, height, step), np.arange(0, width, step), indexing='ij')
+    table = get_summed_area_table(binary_img)
+    area = count_in_windows(table, rows, cols, sample_spacing)
+    area_below = count_in_windows(table, rows + step, cols, sample_spacing)
+    is_candidate = (binary_img[rows, cols] == config.BLACK) & (area > area_threshold) & (area_below > area_threshold)
+    if not is_candidate.any():
+        return None
+    best = np.argmax(np.where(is_candidate, area + area_below, -1))
+    return int(rows.flat[best]), int(cols.flat[best])
+
+
+def extract_reservoir(prdt_arr, seed=None):
+    """
+    Returns the boolean mask of the reservoir: the 4-connected water (BLACK) component containing the seed, or the
+    largest water component when no seed is given. Pixels outside the AOI are NO_DATA and never part of it.
+    """
+    components, num_components = ndimage.label(prdt_arr == config.BLACK)
+    if seed is not None:
+        reservoir_label = components[seed]
+    elif num_components > 0:
+        reservoir_label = np.argmax(np.bincount(components.ravel())[1:]) + 1
+    else:
+        return np.zeros(prdt_arr.shape, dtype=bool)
+    return components == reservoir_label
+
+
+def write_mask(path, msk_arr, crs, transform):
+    height, width = msk_arr.shape
+    with rasterio.open(
+        path,
+        'w',
+        driver='GTiff',
+        height=height,
+        width=width,
+        count=1,
+        dtype=np.uint8,
+        nodata=config.BLACK,
+        crs=crs,
+        transform=transform,
+    ) as dst:
+        dst.write(msk_arr, 1)
+
+
+def get_reservoir_wkt(msk_arr, transform):
+    """
+    Vectorises the reservoir pixels of an in-memory mask and returns the WKT of the first reservoir shape.
+    Only the shapes of RESERVOIR_COLOR are generated and only the first one is consumed.
+    """
+    reservoir_shapes = shapes(msk_arr, mask=msk_arr == config.RESERVOIR_COLOR, transform=transform)
+    geometry, value = next(reservoir_shapes)
+    return str(shape(geometry))
+
+
+def count_reservoir_pixels(msk_arr):
+    return int(np.count_nonzero(msk_arr == config.RESERVOIR_COLOR))
+
+
+def process_scene_safely(process_scene, file_name):
+    """Runs process_scene on one file and returns (file_name, result, error) instead of raising"""
+    try:
+        return file_name, process_scene(file_name), None
+    except Exception as e:
+        return file_name, None, f'{type(e).__name__}: {e}'
+
+
+def run_batch(process_scene, file_names, num_workers=None):
+    """
+    Processes every file with process_scene in a pool of num_workers processes (all cores when None, no pool when 1).
+    A scene that fails is logged and recorded instead of aborting the run.
+    Returns ({file_name: result}, {file_name: error}).
+    """
+    results, failures = {}, {}
+    scene_func = partial(process_scene_safely, process_scene)
+    if num_workers == 1 or len(file_names) <= 1:
+        outcomes = map(scene_func, file_names)
+        _collect_outcomes(outcomes, results, failures)
+    else:
+        with Pool(processes=num_workers) as pool:
+            _collect_outcomes(pool.imap_unordered(scene_func, file_names), results, failures)
+    logger.info(f"Processed {len(results)} scenes, {len(failures)} failed")
+    return results, failures
+
+
+def _collect_outcomes(outcomes, results, failures):
+    for file_name, result, error in outcomes:
+        if error is None:
+            results[file_name] = result
+        else:
+            logger.error(f"{file_name}: {error}")
+            failures[file_name] = error
+
+
+def write_json_atomically(path, data):
+    """Writes the JSON to a temporary file first so that readers never see a partially written file"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, path)
+
+
+def load_json(path, default=None):
+    if not os.path.exists(path):
+        return {} if default is None else default
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def get_file_sha1(path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_input_record(path, previous=None):
+    """
+    Manifest record of an input file. The file is only hashed when its mtime or size differ from the previous record,
+    so that unchanged files cost a single stat
+    """
+    stat = os.stat(path)
+    record = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+    if previous is not None and previous['mtime_ns'] == stat.st_mtime_ns and previous['size'] == stat.st_size:
+        record['sha1'] = previous['sha1']
+    else:
+        record['sha1'] = get_file_sha1(path)
+    return record
+
+
+def get_settings_fingerprint(settings):
+    """sha1 of the processing settings, so that a change of any of them is noticed by the manifest"""
+    return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def update_scene_json(process_scene, loop_dir, file_names, json_path, num_workers=None, incremental=True,
+                      settings=None, get_output_path=None):
+    """
+    Runs process_scene, which returns (key, value), on the classified images and stores the values by key in json_path.
+    In incremental mode a manifest of the input records and produced keys is kept next to the JSON, and only the new or
+    modified images are processed and merged into the existing JSON. Entries of images that no longer exist are removed.
+    The manifest also stores the fingerprint of the settings (everything besides the input that changes the output), and
+    when it differs from the last run every image is processed again. When get_output_path is given (key -> path of a
+    file that process_scene writes, e.g. the mask GTiff), an unchanged image is also processed again if that file is
+    missing. Failed images are left out of the manifest (so they are retried on the next run) and written to
+    failures.json. Returns the failures.
+    """
+    out_dir = os.path.dirname(json_path)
+    manifest_path = os.path.splitext(json_path)[0] + '_manifest.json'
+    failures_path = os.path.join(out_dir, 'failures.json')
+    fingerprint = get_settings_fingerprint(settings or {})
+    manifest = load_json(manifest_path) if incremental else {}
+    if manifest.get('settings') == fingerprint:
+        scene_json = load_json(json_path)
+        inputs = manifest['inputs']
+    else:
+        if manifest:
+            logger.info("The settings changed since the last run, all the images are processed again")
+        scene_json = {}
+        inputs = {}
+
+    records = {}
+    to_process = []
+    for file_name in file_names:
+        previous = inputs.get(file_name)
+        records[file_name] = get_input_record(os.path.join(loop_dir, file_name), previous)
+        if previous is None or previous['sha1'] != records[file_name]['sha1'] or previous['output'] not in scene_json \
+                or (get_output_path is not None and not os.path.exists(get_output_path(previous['output']))):
+            to_process.append(file_name)
+    logger.info(f"{len(to_process)} of {len(file_names)} images are new, modified or missing their output")
+
+    for file_name in set(inputs) - set(file_names):
+        scene_json.pop(inputs.pop(file_name)['output'], None)
+    for file_name in to_process:
+        if file_name in inputs:
+            scene_json.pop(inputs.pop(file_name)['output'], None)
+    for file_name in set(file_names) - set(to_process):
+        inputs[file_name] = dict(records[file_name], output=inputs[file_name]['output'])
+
+    results, failures = run_batch(process_scene, to_process, num_workers)
+    for file_name, (key, value) in results.items():
+        scene_json[key] = value
+        inputs[file_name] = dict(records[file_name], output=key)
+
+    write_json_atomically(json_path, dict(sorted(scene_json.items())))
+    write_json_atomically(manifest_path, {'settings': fingerprint, 'inputs': dict(sorted(inputs.items()))})
+    if failures:
+        write_json_atomically(failures_path, failures)
+    elif os.path.exists(failures_path):
+        os.remove(failures_path)
+    return failures
@@ -20,7 +20,7 @@ from sklearn.pipeline import make_pipeline
 from sklearn.preprocessing import PolynomialFeatures
 
 import basicconfig as config
-from volumedata import volume_data
+from volumedata import series_store
 
 
 def convert_wkt_from_dd_to_m_to_polygon(wkt_in):
@@ -205,22 +205,22 @@ areas = []
 test_x = []
 test_y = []
 all_data_masks_dir = [mask_2016_dir, mask_2017_dir, mask_2018_dir, mask_2019_dir, mask_2020_dir]
+# fetch the volumes of all the years at once, so that startup is bounded by the slowest request
+series_store.sync_missing_years(range(2016, 2021), names=(series_store.VOLUME,))
 for mask_dir in all_data_masks_dir:
     data = open(mask_dir + 'data.json', 'r', encoding='utf-8')
     mask_wkt_json = json.load(data)
     data.close()
-    for key in mask_wkt_json.keys():
-        if '.json' in key:
-            continue
+    keys = [key for key in mask_wkt_json.keys() if '.json' not in key]
+    mask_dates = [datetime.strptime(key.split('_')[0], config.DATE_FORMAT).date() for key in keys]
+    # get actual volume for all the dates from the local store
+    mask_vols = series_store.get_volumes_for_dates(mask_dates)
+    for key, date, vol in zip(keys, mask_dates, mask_vols):
         logger.info("Current folder: " + key)
-        date = datetime.strptime(key.split('_')[0], config.DATE_FORMAT).date()
 
         # get area
         area = convert_wkt_from_dd_to_m_to_polygon(mask_wkt_json[key]).area
 
-        # get actual volume for particular date
-        vol = volume_data.get_volume_for_date(date)
-
         # add to list
         if '2020' in mask_dir:
             test_y.append(area)
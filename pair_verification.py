@@ -0,0 +1,182 @@
+"""
+Functions for verifying the vertical displacement of interferogram (master-slave) pairs against in situ data
+"""
+import logging
+import math
+from datetime import datetime
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.mask import raster_geometry_mask
+from shapely.wkt import loads
+
+import basicconfig as config
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of polygon windows kept in the cache (the reservoir masks differ per date, the GCA is always reused)
+MAX_CACHED_WINDOWS = 64
+
+# Pixel windows of the polygons, keyed by the polygon and the raster grid
+_polygon_window_cache = {}
+
+
+def get_polygon_window(raster, wkt, all_touched=False):
+    """
+    Rasterises the polygon once per raster grid. Returns the window of the polygon and a mask that is True for the
+    pixels of the window lying outside the polygon
+    """
+    key = (wkt, all_touched, tuple(raster.transform), raster.height, raster.width)
+    if key not in _polygon_window_cache:
+        if len(_polygon_window_cache) >= MAX_CACHED_WINDOWS:
+            _polygon_window_cache.pop(next(iter(_polygon_window_cache)))
+        outside, out_transform, window = raster_geometry_mask(raster, [loads(wkt)], all_touched=all_touched, crop=True)
+        _polygon_window_cache[key] = (window, outside)
+    return _polygon_window_cache[key]
+
+
+def read_polygon(raster, wkt, nodata=None, all_touched=False):
+    """
+    Same as rasterio.mask.mask(raster, [polygon], nodata=nodata, all_touched=all_touched, crop=True) for the first
+    band, but only the window of the polygon is read from disk. Pixels outside the polygon or equal to the nodata of
+    the raster are filled with nodata (the raster nodata, or 0, when None).
+    """
+    window, outside = get_polygon_window(raster, wkt, all_touched)
+    if nodata is None:
+        nodata = raster.nodata if raster.nodata is not None else 0
+    arr = raster.read(1, window=window, masked=True)
+    arr.mask = arr.mask | outside
+    return arr.filled(nodata)
+
+
+def filter_displacement(disp_arr, coh_arr=None, coh_threshold=config.COH_THRESHOLD):
+    """
+    Returns the displacement pixels that are not nan and, when a coherence array of the same grid is given, whose
+    coherence is above the threshold. Both conditions are applied with a single boolean mask.
+    """
+    disp_arr = disp_arr.ravel()
+    valid = ~np.isnan(disp_arr)
+    if coh_arr is not None:
+        valid &= coh_arr.ravel() > coh_threshold
+    return disp_arr[valid]
+
+
+def get_displacement_stats(disp_values, disp_error):
+    """Min, max and mean displacement corrected by the displacement error of the ground control area"""
+    if disp_values.size == 0:
+        return {'min': np.nan, 'max': np.nan, 'mean': np.nan}
+    return {'min': float(disp_values.min() - disp_error),
+            'max': float(disp_values.max() - disp_error),
+            'mean': float(disp_values.mean() - disp_error)}
+
+
+def get_pair_dates(file):
+    """Returns the master and slave names (YYYYMMDD_VV) and dates of a snaphu pair folder"""
+    name_split = file.split('_')
+    master_timestamp = name_split[0][:8]
+    slave_timestamp = name_split[1][:8]
+    master_date = datetime.strptime(master_timestamp, "%Y%m%d").date()
+    slave_date = datetime.strptime(slave_timestamp, "%Y%m%d").date()
+    return f'{master_timestamp}_VV', f'{slave_timestamp}_VV', master_date, slave_date
+
+
+def get_volume_change(height_change, area_m, area_s):
+    """Volume (million cubic metres) of the frustum between the master and slave water surfaces"""
+    return height_change / 3 * (area_m + area_s + math.sqrt(area_m * area_s)) / 1000000
+
+
+def get_height_change(volume_change, area_m, area_s):
+    return volume_change * 3 / (area_m + area_s + math.sqrt(area_m * area_s)) * 1000000
+
+
+def verify_pair(file, interferogram_dir, mask_wkt_json, gca_wkt, convert_wkt_to_m):
+    """
+    Estimates the change in water level of one master-slave pair from the displacement inside the smaller of the two
+    reservoir masks, corrected by the mean displacement of the ground control area. Returns a row of the results table
+    """
+    master_name, slave_name, master_date, slave_date = get_pair_dates(file)
+    area_m = convert_wkt_to_m(mask_wkt_json[master_name]).area
+    area_s = convert_wkt_to_m(mask_wkt_json[slave_name]).area
+    lc_wkt = mask_wkt_json[slave_name] if area_s < area_m else mask_wkt_json[master_name]
+    file_prefix = file[:-3]
+    disp_path = interferogram_dir + f"{file_prefix}_vert_disp_subset_{config.POLARIZATIONS}.data\\vert_disp_VV.img"
+
+    with rasterio.open(disp_path) as disp_raster:
+        lc_arr = read_polygon(disp_raster, lc_wkt, nodata=np.nan)
+        # get reference point to minus off error
+        lc_gca_arr = read_polygon(disp_raster, gca_wkt, all_touched=True)
+        res_x, res_y = disp_raster.res
+    disp_error = float(np.nanmean(lc_gca_arr))
+
+    # consider only pixels that have coherence > COH_THRESHOLD, when the coherence of the pair is available
+    try:
+        with rasterio.open(interferogram_dir + file_prefix + f'_coh_{config.POLARIZATIONS}.tif') as coh_raster:
+            coh_arr = read_polygon(coh_raster, lc_wkt, nodata=np.nan)
+    except rasterio.errors.RasterioIOError:
+        coh_arr = None
+    if coh_arr is not None and coh_arr.size != lc_arr.size:
+        raise ValueError(f"Length of displacement array and coherence array is different! disp len: {lc_arr.size}, "
+                         f"coh len: {coh_arr.size}")
+    lc_arr_filtered = filter_displacement(lc_arr, coh_arr)
+    logger.info(f"{file}: {len(lc_arr_filtered)} pixels")
+
+    disp_stats = get_displacement_stats(lc_arr_filtered, disp_error)
+    return {'pair': file,
+            'master': master_name,
+            'slave': slave_name,
+            'master_date': master_date,
+            'slave_date': slave_date,
+            'res_x': res_x,
+            'res_y': res_y,
+            'area_master': area_m,
+            'area_slave': area_s,
+            'num_pixels': int(lc_arr_filtered.size),
+            'disp_error': disp_error,
+            'min_disp': disp_stats['min'],
+            'max_disp': disp_stats['max'],
+            'mean_disp': disp_stats['mean'],
+            'est_vol_change': get_volume_change(disp_stats['mean'], area_m, area_s)}
+
+
+def verify_pairs(files, interferogram_dir, mask_wkt_json, gca_wkt, convert_wkt_to_m, num_workers=None):
+    """Runs verify_pair on every pair in a pool of num_workers processes (all cores when None, no pool when 1)"""
+    pair_func = partial(verify_pair, interferogram_dir=interferogram_dir, mask_wkt_json=mask_wkt_json,
+                        gca_wkt=gca_wkt, convert_wkt_to_m=convert_wkt_to_m)
+    if num_workers == 1 or len(files) <= 1:
+        return [pair_func(file) for file in files]
+    with Pool(processes=num_workers) as pool:
+        return pool.map(pair_func, files)
+
+
+def format_pair_report(result):
+    """Text report of one pair, in the format of the earlier verification runs"""
+    lines = [f'master: {result["master"]}\n',
+             f'slave: {result["slave"]}\n',
+             f'resolution (m): {(result["res_x"], result["res_y"])}\n',
+             f'displacement error: {result["disp_error"]} m\n',
+             f'max displacement: {result["max_disp"]} m\n',
+             f'min displacement: {result["min_disp"]} m\n',
+             f'mean displacement: {result["mean_disp"]} m\n',
+             f'area of master: {result["area_master"]} m^2\n',
+             f'area of slave: {result["area_slave"]} m^2\n']
+    # the in situ changes are only known when a volume or water level series is available for the reservoir
+    if 'act_vol_change' in result:
+        lines.append(f'est vol changed: {result["est_vol_change"]} million cubic metres\n')
+        lines.append(f'act vol changed: {result["act_vol_change"]} million cubic metres\n')
+    if 'act_height_change' in result:
+        lines.append(f'Actual height change: {result["act_height_change"]} m\n')
+    lines.append('\n')
+    return lines
+
+
+def write_results_table(results, path):
+    """Writes one row per pair, as Parquet when the path ends with .parquet and as CSV otherwise"""
+    df = pd.DataFrame(results)
+    if path.endswith('.parquet'):
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+    return df
@@ -1,22 +1,24 @@
 import logging
 import os
 import platform
+import time
 
 import numpy as np
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.model_selection import cross_val_score
+from sklearn.linear_model import SGDClassifier
+from sklearn.model_selection import StratifiedKFold, cross_validate
 from sklearn.neighbors import KNeighborsClassifier
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler
 from sklearn.svm import SVC
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from sklearn.metrics import accuracy_score
 from sklearn.decomposition import PCA
 import matplotlib.pyplot as plt
 
 import basicconfig as config
 import filemanager
-from trainingdata import get_labelled_features_as_df
+from trainingdata import get_cached_labelled_features_as_df
 
 
 # Initialise logger
@@ -32,57 +34,165 @@ loop_dir = output_dir + config.LC_PATH
 ml_dir = output_dir + config.ML_DIR
 classified_LC_dir = output_dir + config.LC_CLASSIFIED_DIR
 
-num_trees = 50
-num_neigh = 3
-c_val = 1.0
-for i in range(11):
-    clf_names = [f"RF (num trees = {num_trees})", f"K-NN (k = {num_neigh})", f"SVM with regularization , C = {c_val}", "KMeans (cluster=2)"]
-    results = [[] for j in range(len(clf_names))]
-    count = 0
-    for folder in os.listdir(loop_dir):
-        if folder.endswith('.data') and f'glcm_{config.POLARIZATIONS}' in folder:
-            count += 1
-            logger.info(folder)
-            feature_df = get_labelled_features_as_df(loop_dir + folder)
-            dataset = feature_df.iloc[:, :-1]
-            labels = feature_df.iloc[:, -1:]
-            y = np.array(labels).flatten()
-
-            rf_clf = RandomForestClassifier(n_estimators=num_trees)
-            scaler = StandardScaler()
-            pipeline = Pipeline([('transformer', scaler), ('estimator', rf_clf)])
-            result = cross_val_score(pipeline, dataset, y, cv=10)
-            results[0].append(result.tolist())
-
-            knn_clf = KNeighborsClassifier(n_neighbors=num_neigh)
-            scaler = StandardScaler()
-            pipeline = Pipeline([('transformer', scaler), ('estimator', knn_clf)])
-            result = cross_val_score(pipeline, dataset, y, cv=10)
-            results[1].append(result.tolist())
-
-            svm_rbf_clf = SVC(gamma='auto', C=c_val)
-            scaler = StandardScaler()
-            pipeline = Pipeline([('transformer', scaler), ('estimator', svm_rbf_clf)])
-            result = cross_val_score(pipeline, dataset, y, cv=10)
-            results[2].append(result.tolist())
-
-            if count == 20:
-                break
-    c_val += 0.1
-    num_neigh += 2
-    num_trees += 10
-
-
-    clf_results = []
-    for k in range(len(clf_names)):
-        curr_result = np.array(results[k])
-        clf_results.append(f"{clf_names[k]} - Accuracy: %.3f%% (%.3f%%)\n" % (curr_result.mean() * 100.0, curr_result.std() * 100.0))
-    clf_results.append("\n\n")
+# Maximum number of folders used in the hyperparameter sweep
+max_sweep_folders = 20
+# Number of jobs for the cross validation folds (-1 uses all cores)
+cv_n_jobs = -1
+# Cap on the number of samples of each class kept per folder (stratified random subsample). None keeps all samples
+max_samples_per_class = None
+# Mini-batch size of the streaming learners (SGD with partial_fit and mini-batch k-means)
+stream_batch_size = 4096
+# Number of passes of the streaming SGD over the training samples, each in a new random order
+stream_epochs = 5
+
+
+def subsample_per_class(dataset, y, max_per_class, random_state=0):
+    """Keeps at most max_per_class randomly chosen samples of every class"""
+    rng = np.random.RandomState(random_state)
+    keep = []
+    for label in np.unique(y):
+        label_idx = np.flatnonzero(y == label)
+        if label_idx.size > max_per_class:
+            label_idx = rng.choice(label_idx, size=max_per_class, replace=False)
+        keep.append(label_idx)
+    keep = np.sort(np.concatenate(keep))
+    return dataset.iloc[keep], y[keep]
+
+
+def load_datasets(folders):
+    """Loads the labelled dataset of every folder once, as (features, labels) pairs"""
+    datasets = []
+    for folder in folders:
+        logger.info(folder)
+        feature_df = get_cached_labelled_features_as_df(loop_dir + folder)
+        dataset = feature_df.iloc[:, :-1]
+        labels = feature_df.iloc[:, -1:]
+        y = np.array(labels).flatten()
+        if max_samples_per_class is not None:
+            dataset, y = subsample_per_class(dataset, y, max_samples_per_class)
+        datasets.append((dataset, y))
+    return datasets
+
+
+def get_parameter_grid(num_iterations=11):
+    """Returns the (num trees, num neighbours, C) of every sweep iteration"""
+    grid = []
+    num_trees = 50
+    num_neigh = 3
+    c_val = 1.0
+    for i in range(num_iterations):
+        grid.append((num_trees, num_neigh, c_val))
+        c_val += 0.1
+        num_neigh += 2
+        num_trees += 10
+    return grid
+
+
+def get_pipelines(num_trees, num_neigh, c_val):
+    classifiers = [RandomForestClassifier(n_estimators=num_trees),
+                   KNeighborsClassifier(n_neighbors=num_neigh),
+                   SVC(gamma='auto', C=c_val)]
+    return [Pipeline([('transformer', StandardScaler()), ('estimator', clf)]) for clf in classifiers]
+
+
+def format_result(clf_name, scores, fit_times, predict_times):
+    scores = np.array(scores)
+    return f"{clf_name} - Accuracy: %.3f%% (%.3f%%), fit: %.3fs, predict: %.3fs\n" % (
+        scores.mean() * 100.0, scores.std() * 100.0, np.mean(fit_times), np.mean(predict_times))
+
+
+def write_report(lines):
     out = open(output_dir + "comparison_ML.txt", 'a')
-    out.writelines(clf_results)
+    out.writelines(lines)
     out.close()
 
-results = []
+
+def run_comparison(datasets, grid, n_jobs=cv_n_jobs):
+    """
+    Evaluates every classifier of every grid point on the preloaded datasets and appends the accuracy and the mean
+    fit/predict time per fold to comparison_ML.txt
+    """
+    for num_trees, num_neigh, c_val in grid:
+        clf_names = [f"RF (num trees = {num_trees})", f"K-NN (k = {num_neigh})", f"SVM with regularization , C = {c_val}"]
+        results = [{'test_score': [], 'fit_time': [], 'score_time': []} for j in range(len(clf_names))]
+        for dataset, y in datasets:
+            for k, pipeline in enumerate(get_pipelines(num_trees, num_neigh, c_val)):
+                result = cross_validate(pipeline, dataset, y, cv=10, n_jobs=n_jobs)
+                for metric in results[k]:
+                    results[k][metric].extend(result[metric].tolist())
+
+        clf_results = []
+        for k in range(len(clf_names)):
+            clf_results.append(format_result(clf_names[k], results[k]['test_score'], results[k]['fit_time'],
+                                             results[k]['score_time']))
+        clf_results.append("\n\n")
+        write_report(clf_results)
+
+
+def iter_batches(num_samples, batch_size):
+    for start in range(0, num_samples, batch_size):
+        yield slice(start, min(start + batch_size, num_samples))
+
+
+def evaluate_streaming_sgd(dataset, y, batch_size=stream_batch_size, epochs=stream_epochs, cv=10, random_state=0):
+    """
+    Cross validates a linear SVM trained with SGD that only ever sees one mini-batch at a time (partial_fit), as it
+    would when streaming over scenes that do not fit in memory. The samples are stored class by class, so every epoch
+    visits them in a new random order; otherwise each mini-batch holds a single class. Returns the scores and
+    fit/predict time per fold
+    """
+    x = np.asarray(dataset, dtype=np.float32)
+    classes = np.unique(y)
+    rng = np.random.default_rng(random_state)
+    scores, fit_times, predict_times = [], [], []
+    for train_idx, test_idx in StratifiedKFold(n_splits=cv, shuffle=True, random_state=random_state).split(x, y):
+        scaler = StandardScaler()
+        clf = SGDClassifier(loss='hinge')
+        start = time.perf_counter()
+        train_idx = rng.permutation(train_idx)
+        for batch in iter_batches(train_idx.size, batch_size):
+            scaler.partial_fit(x[train_idx[batch]])
+        for epoch in range(epochs):
+            train_idx = rng.permutation(train_idx)
+            for batch in iter_batches(train_idx.size, batch_size):
+                clf.partial_fit(scaler.transform(x[train_idx[batch]]), y[train_idx[batch]], classes=classes)
+        fit_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        predicted = clf.predict(scaler.transform(x[test_idx]))
+        predict_times.append(time.perf_counter() - start)
+        scores.append(accuracy_score(y[test_idx], predicted))
+    return scores, fit_times, predict_times
+
+
+def fit_predict_kmeans(dataset):
+    """Clusters the scaled dataset into 2 clusters with mini-batch k-means. Returns the cluster of every sample"""
+    kmeans_clf = MiniBatchKMeans(n_clusters=2, init='random', n_init=3, batch_size=stream_batch_size, max_iter=1000)
+    # kmeans_clf = KMeans(n_clusters=2, init='random', n_init=25, max_iter=1000)
+    start = time.perf_counter()
+    kmeans_clf.fit(dataset)
+    fit_time = time.perf_counter() - start
+    start = time.perf_counter()
+    predicted = kmeans_clf.predict(dataset)
+    return predicted, fit_time, time.perf_counter() - start
+
+
+def run_streaming_comparison(datasets):
+    """Appends the accuracy and fit/predict timings of the streaming learners to comparison_ML.txt"""
+    sgd_results = ([], [], [])
+    kmeans_results = ([], [], [])
+    for dataset, y in datasets:
+        for results, result in zip(sgd_results, evaluate_streaming_sgd(dataset, y)):
+            results.extend(result)
+        predicted, fit_time, predict_time = fit_predict_kmeans(StandardScaler().fit_transform(dataset))
+        kmeans_results[0].append(accuracy_score(y, predicted))
+        kmeans_results[1].append(fit_time)
+        kmeans_results[2].append(predict_time)
+
+    sgd_name = f"SGD linear SVM (streaming, batch = {stream_batch_size}, epochs = {stream_epochs})"
+    write_report([format_result(sgd_name, *sgd_results),
+                  format_result(f"Mini-batch KMeans (cluster=2, batch = {stream_batch_size})", *kmeans_results),
+                  "\n\n"])
 
 
 def visualize_clusters(data):
@@ -120,24 +230,28 @@ def visualize_clusters(data):
     plt.show()
 
 
-for folder in os.listdir(loop_dir):
-    if folder.endswith('.data') and f'glcm_{config.POLARIZATIONS}' in folder:
-        logger.info(folder)
-        feature_df = get_labelled_features_as_df(loop_dir + folder)
+def run_kmeans_clustering(datasets):
+    results = []
+    for dataset, y in datasets:
         scaler = StandardScaler()
-        dataset = feature_df.iloc[:, :-1]
         dataset = scaler.fit_transform(dataset)
-        labels = feature_df.iloc[:, -1:]
-        y = np.array(labels).flatten()
-        pca = PCA(n_components=2).fit(dataset)
+        # pca = PCA(n_components=2).fit(dataset)
         # kmeans_clf = KMeans(n_clusters=2, init=pca.components_, n_init=1, max_iter=1000)
-        kmeans_clf = KMeans(n_clusters=2, init='random', n_init=25, max_iter=1000)
-        kmeans_clf.fit(dataset)
-        predicted = kmeans_clf.predict(dataset)
+        predicted, fit_time, predict_time = fit_predict_kmeans(dataset)
+        logger.info(f"k-means fit: {fit_time:.3f}s, predict: {predict_time:.3f}s")
         results.append(accuracy_score(y, predicted))
 
         visualize_clusters(dataset)
 
-results = np.array(results)
-print('K-means clustering:')
-print("Accuracy: %.3f%% (%.3f%%)\n" % (results.mean() * 100.0, results.std() * 100.0))
+    results = np.array(results)
+    print('K-means clustering:')
+    print("Accuracy: %.3f%% (%.3f%%)\n" % (results.mean() * 100.0, results.std() * 100.0))
+
+
+if __name__ == '__main__':
+    folders = [folder for folder in os.listdir(loop_dir)
+               if folder.endswith('.data') and f'glcm_{config.POLARIZATIONS}' in folder]
+    all_datasets = load_datasets(folders)
+    run_comparison(all_datasets[:max_sweep_folders], get_parameter_grid())
+    run_streaming_comparison(all_datasets[:max_sweep_folders])
+    run_kmeans_clustering(all_datasets)
@@ -2,7 +2,10 @@ import logging
 import os
 import platform
 import statistics
+from functools import partial
+from multiprocessing import Pool
 
+import joblib
 import numpy as np
 import pandas as pd
 import rasterio
@@ -13,11 +16,13 @@ from rasterio.crs import CRS
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.metrics import confusion_matrix, classification_report, accuracy_score
 from sklearn.model_selection import train_test_split
+from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler
+from threadpoolctl import threadpool_limits
 
 import basicconfig as config
 import filemanager
-from trainingdata import get_labelled_features_as_df, extract_features_from
+from trainingdata import get_cached_labelled_features_as_df, iter_feature_blocks, DEFAULT_BLOCK_ROWS
 
 input_dir, output_dir = filemanager.get_file_paths_based_on_os(platform.system(), filemanager.Product.grd)
 # input_dir = output_dir + config.LC_PATH
@@ -33,14 +38,44 @@ input_dir, output_dir = filemanager.get_file_paths_based_on_os(platform.system()
 
 input_dir = "D:\\Texana\\" + "Processing\\" + config.LC_PATH
 classified_LC_dir = "D:\\Texana\\" + "Processing\\" + config.LC_CLASSIFIED_DIR
+ml_dir = "D:\\Texana\\" + "Processing\\" + config.ML_DIR
 
 
-def get_random_forest_model(train_x, train_y, num_estimators):
-    rf = RandomForestClassifier(n_estimators=num_estimators)
+def get_random_forest_model(train_x, train_y, num_estimators, n_jobs=None):
+    rf = RandomForestClassifier(n_estimators=num_estimators, n_jobs=n_jobs)
     rf.fit(train_x, train_y)
     return rf
 
 
+def predict_to_mask(clf, scaler, folder_path, out_path, block_rows=DEFAULT_BLOCK_ROWS):
+    """
+    Scales and classifies the scene one block of rows at a time and writes every block straight into the
+    land-water mask GTiff (land in white, water in black), so memory is bounded by the block size
+    """
+    with rasterio.open(os.path.join(folder_path, f'Sigma0_{config.POLARIZATIONS}_GLCMMean.img')) as prdt:
+        height, width, crs, transform = prdt.height, prdt.width, prdt.crs, prdt.transform
+        # read whole internal blocks of the source rasters
+        src_block_rows = prdt.block_shapes[0][0]
+    block_rows = max(block_rows // src_block_rows, 1) * src_block_rows
+
+    with rasterio.open(
+            out_path,
+            'w',
+            driver='GTiff',
+            height=height,
+            width=width,
+            count=1,
+            dtype=np.uint8,
+            crs=crs,
+            transform=transform,
+    ) as dst:
+        for window, features in iter_feature_blocks(folder_path, block_rows):
+            predicted_flatten = clf.predict(scaler.transform(features))
+            # convert the prediction in black and white image
+            predicted = np.where(predicted_flatten == config.WATER, config.BLACK, config.WHITE).astype(np.uint8)
+            dst.write(predicted.reshape(int(window.height), int(window.width)), 1, window=window)
+
+
 # Initialise logger
 logging.basicConfig(
     format='%(asctime)s %(levelname)-8s %(name)s: %(message)s',
@@ -78,95 +113,160 @@ def plot_feature_importance(feature_names, importances):
     plt.show()
 
 
+def limit_worker_threads(num_threads):
+    """Pool initializer: caps the BLAS/OpenMP threads of each worker so that the workers do not oversubscribe the cores"""
+    threadpool_limits(limits=num_threads)
+
+
+def classify_scene(folder, num_threads=1):
+    """Trains a random forest on the labelled pixels of one .data folder, evaluates it and writes the land-water mask"""
+    logger.info(folder)
+    # for a in range(100):
+    # feature_df = get_labelled_data(loop_dir + '\\' + folder)
+    feature_df = get_cached_labelled_features_as_df(loop_dir + folder)
+    # print(feature_df)
+    logger.info(feature_df.dtypes)
+    data = feature_df.iloc[:, :-1]
+    labels = feature_df.iloc[:, -1:]
+    # logger.info(f'Labelled set (Total): num of land pixels: {land_shape}, num of water pixels: {water_shape}')
+    tr_x, test_x, tr_y, test_y = train_test_split(data, labels, train_size=0.7, stratify=labels)
+    scaler = StandardScaler()
+    tr_x_scaled = scaler.fit_transform(tr_x)
+    test_x_scaled = scaler.transform(test_x)
+    tr_y = np.array(tr_y).flatten()
+    test_y = np.array(test_y).flatten()
+
+    logger.info(f"train_x shape: {tr_x.shape}")
+    logger.info(f"test_x shape: {test_x.shape}")
+    num_land_test = test_y[test_y == config.LAND]
+    logger.info(f"num of land test pixels: {num_land_test.shape}")
+    num_water_test = test_y[test_y == config.WATER]
+    logger.info(f"num of water test pixels: {num_water_test.shape}")
+
+    logger.info("Fitting model...")
+    clf = get_random_forest_model(tr_x_scaled, tr_y, num_estimators=100, n_jobs=num_threads)
+
+    # feat_importances = clf.feature_importances_
+
+    # plot_feature_importance(feat_list, feat_importances)
+    # feat_impt_list.append(feat_importances)
+
+    # feat_impt_dict = list(zip(feat_list, feat_importances))
+    # logger.info(f'Feature importance: {feat_impt_dict}')
+
+    logger.info("Classifying and evaluating test set")
+    test_y_pred = clf.predict(test_x_scaled)
+
+    confusion_mtx = confusion_matrix(test_y, test_y_pred)
+    timestamp = folder.split("_")[4]
+    # c_mtx = pretty_confusion_matrix(confusion_mtx, "Land-water classification", timestamp, ['Land', 'Water'])
+    # c_mtx.savefig(ml_dir + "cm.jpg")
+    # c_mtx.show()
+    accuracy = accuracy_score(test_y, test_y_pred)
+    print(classification_report(test_y, test_y_pred))
+
+    tn, fp, fn, tp = confusion_mtx.ravel()
+    logger.debug("(tn: {}, fp: {}, fn: {}, tp: {}):".format(tn, fp, fn, tp))
+
+    logger.info("Classifying whole image...")
+    predict_to_mask(clf, scaler, input_dir + folder,
+                    classified_LC_dir + f"land_water_mask_rf_{timestamp}_{config.POLARIZATIONS}.tif")
+    logger.info("Done predicting")
+    return accuracy
+
+
+def train_pooled_model(pool, training_folders, num_estimators=100, n_jobs=None):
+    """
+    Fits a single scaler + random forest pipeline on the labelled pixels pooled from all the training folders.
+    Returns the pipeline and its accuracy on a held out 30% of the pooled samples.
+    """
+    feature_dfs = pool.map(get_cached_labelled_features_as_df, [loop_dir + folder for folder in training_folders])
+    feature_df = pd.concat(feature_dfs, ignore_index=True)
+    data = feature_df.iloc[:, :-1]
+    labels = np.array(feature_df.iloc[:, -1:]).flatten()
+    tr_x, test_x, tr_y, test_y = train_test_split(data, labels, train_size=0.7, stratify=labels)
+    logger.info(f"Fitting pooled model on {tr_x.shape[0]} samples from {len(training_folders)} scenes...")
+    pipeline = Pipeline([('transformer', StandardScaler()),
+                         ('estimator', RandomForestClassifier(n_estimators=num_estimators, n_jobs=n_jobs))])
+    pipeline.fit(tr_x, tr_y)
+    test_y_pred = pipeline.predict(test_x)
+    accuracy = accuracy_score(test_y, test_y_pred)
+    print(classification_report(test_y, test_y_pred))
+    return pipeline, accuracy
+
+
+def save_model(pipeline, path):
+    joblib.dump(pipeline, path)
+
+
+# Models loaded by this process, keyed by path, so that each worker only loads the model once
+_loaded_models = {}
+
+
+def load_model(path, n_jobs=None):
+    if path not in _loaded_models:
+        pipeline = joblib.load(path)
+        pipeline.named_steps['estimator'].n_jobs = n_jobs
+        _loaded_models[path] = pipeline
+    return _loaded_models[path]
+
+
+def apply_model_to_scene(folder, model_path, num_threads=1):
+    """Classifies one .data folder with the persisted pipeline and writes the land-water mask (inference only)"""
+    logger.info(folder)
+    pipeline = load_model(model_path, n_jobs=num_threads)
+    timestamp = folder.split("_")[4]
+    predict_to_mask(pipeline.named_steps['estimator'], pipeline.named_steps['transformer'], input_dir + folder,
+                    classified_LC_dir + f"land_water_mask_rf_{timestamp}_{config.POLARIZATIONS}.tif")
+    logger.info("Done predicting")
+
+
 # Get dataset
 loop_dir = input_dir
-acc_list = []
-for folder in os.listdir(loop_dir):
-    # acc_list = []
-    # feat_impt_list = []
-    if folder.endswith('.data') and f'glcm_{config.POLARIZATIONS}' in folder:
-            logger.info(folder)
-        # for a in range(100):
-            # feature_df = get_labelled_data(loop_dir + '\\' + folder)
-            feature_df = get_labelled_features_as_df(loop_dir + folder)
-            # print(feature_df)
-            logger.info(feature_df.dtypes)
-            data = feature_df.iloc[:, :-1]
-            labels = feature_df.iloc[:, -1:]
-            # logger.info(f'Labelled set (Total): num of land pixels: {land_shape}, num of water pixels: {water_shape}')
-            tr_x, test_x, tr_y, test_y = train_test_split(data, labels, train_size=0.7, stratify=labels)
-            scaler = StandardScaler()
-            tr_x_scaled = scaler.fit_transform(tr_x)
-            test_x_scaled = scaler.transform(test_x)
-            tr_y = np.array(tr_y).flatten()
-            test_y = np.array(test_y).flatten()
-
-            logger.info(f"train_x shape: {tr_x.shape}")
-            logger.info(f"test_x shape: {test_x.shape}")
-            num_land_test = test_y[test_y == config.LAND]
-            logger.info(f"num of land test pixels: {num_land_test.shape}")
-            num_water_test = test_y[test_y == config.WATER]
-            logger.info(f"num of water test pixels: {num_water_test.shape}")
-
-            logger.info("Fitting model...")
-
-
-            clf = get_random_forest_model(tr_x_scaled, tr_y, num_estimators=100)
-
-            feat_list = data.columns.values.tolist()
-            # feat_importances = clf.feature_importances_
-
-            # plot_feature_importance(feat_list, feat_importances)
-            # feat_impt_list.append(feat_importances)
-
-            # feat_impt_dict = list(zip(feat_list, feat_importances))
-            # logger.info(f'Feature importance: {feat_impt_dict}')
-
-            logger.info("Classifying and evaluating test set")
-            test_y_pred = clf.predict(test_x_scaled)
-
-            confusion_mtx = confusion_matrix(test_y, test_y_pred)
-            timestamp = folder.split("_")[4]
-            # c_mtx = pretty_confusion_matrix(confusion_mtx, "Land-water classification", timestamp, ['Land', 'Water'])
-            # c_mtx.savefig(ml_dir + "cm.jpg")
-            # c_mtx.show()
-            acc_list.append(accuracy_score(test_y, test_y_pred))
-            print(classification_report(test_y, test_y_pred))
-
-            tn, fp, fn, tp = confusion_mtx.ravel()
-            logger.debug("(tn: {}, fp: {}, fn: {}, tp: {}):".format(tn, fp, fn, tp))
-
-            logger.info("Classifying whole image...")
-            prdt = rasterio.open(loop_dir + '\\' + folder + '\\' + f'Sigma0_{config.POLARIZATIONS}_GLCMMean.img')
-            to_predict = extract_features_from(input_dir + folder)
-            to_predict_scaled = scaler.transform(to_predict)
-            predicted_flatten = clf.predict(to_predict_scaled)
-            logger.info("Done predicting")
+# Scenes are independent, so they are classified in parallel. Each worker gets threads_per_worker BLAS/sklearn threads
+threads_per_worker = 1
+num_workers = max((os.cpu_count() or 1) // threads_per_worker, 1)
+# 'per_scene' fits a model for every scene. 'train_once' fits one model on the pooled samples of the scenes acquired
+# on training_dates (YYYYMMDD), persists it to model_path and then only runs inference on every scene (the training
+# scenes included, so that each date gets a land-water mask).
+# The persisted model is reused on later runs unless retrain_model is set.
+classification_mode = 'per_scene'
+training_dates = []
+model_path = ml_dir + f"land_water_rf_{config.POLARIZATIONS}.joblib"
+retrain_model = False
 
-            # convert the prediction in black and white image
-            predicted_flatten[predicted_flatten == config.LAND] = config.WHITE
-            predicted_flatten[predicted_flatten == config.WATER] = config.BLACK
-            predicted = np.reshape(predicted_flatten, (-1, prdt.width))
-            predicted = predicted.astype('uint8')
-            # img = Image.fromarray(predicted)
-            # img.show()
-
-            with rasterio.open(
-                    classified_LC_dir + f"land_water_mask_rf_{timestamp}_{config.POLARIZATIONS}.tif",
-                    'w',
-                    driver='GTiff',
-                    height=prdt.height,
-                    width=prdt.width,
-                    count=1,
-                    dtype=np.uint8,
-                    crs=prdt.crs,
-                    transform=prdt.transform,
-            ) as dst:
-                dst.write(predicted, 1)
-
-print(f"Mean accuracy: {statistics.mean(acc_list) * 100}%")
-# mean_acc = np.mean(np.array(acc_list))
-# print(mean_acc)
-# mean_impt = np.mean(np.array(feat_impt_list), axis=0)
-# print(mean_impt)
-# plot_feature_importance(feat_list, mean_impt)
+if __name__ == '__main__':
+    # Inherited by spawned workers before they import numpy/sklearn
+    for env_var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[env_var] = str(threads_per_worker)
+
+    folders = [folder for folder in os.listdir(loop_dir)
+               if folder.endswith('.data') and f'glcm_{config.POLARIZATIONS}' in folder]
+    training_folders = [folder for folder in folders if folder.split("_")[4][:8] in training_dates]
+    train_model = classification_mode == 'train_once' and (retrain_model or not os.path.exists(model_path))
+    if train_model and not training_dates:
+        raise ValueError("training_dates is empty, set the acquisition dates (YYYYMMDD) of the training scenes to "
+                         "train the train_once model")
+    if train_model and not training_folders:
+        raise ValueError(f"None of training_dates {training_dates} matches a scene folder in {loop_dir}")
+    with Pool(processes=min(num_workers, max(len(folders), 1)), initializer=limit_worker_threads,
+              initargs=(threads_per_worker,)) as pool:
+        if classification_mode == 'train_once':
+            if train_model:
+                model, accuracy = train_pooled_model(pool, training_folders, n_jobs=num_workers)
+                save_model(model, model_path)
+                acc_list = [accuracy]
+            else:
+                logger.info(f"Reusing model at {model_path}")
+                acc_list = []
+            pool.map(partial(apply_model_to_scene, model_path=model_path, num_threads=threads_per_worker), folders)
+        else:
+            acc_list = pool.map(partial(classify_scene, num_threads=threads_per_worker), folders)
+
+    if acc_list:
+        print(f"Mean accuracy: {statistics.mean(acc_list) * 100}%")
+    # mean_acc = np.mean(np.array(acc_list))
+    # print(mean_acc)
+    # mean_impt = np.mean(np.array(feat_impt_list), axis=0)
+    # print(mean_impt)
+    # plot_feature_importance(feat_list, mean_impt)
@@ -1,6 +1,7 @@
 """
 Functions for generating training data for machine learning
 """
+import hashlib
 import json
 import os
 from datetime import datetime
@@ -11,6 +12,7 @@ import pandas as pd
 import pyproj
 import rasterio
 from rasterio import mask
+from rasterio.windows import Window, union
 from shapely.ops import transform
 from shapely.wkt import loads
 from skimage.filters import threshold_mean, threshold_triangle
@@ -18,7 +20,20 @@ from skimage.morphology import opening
 from sklearn.preprocessing import normalize
 
 import basicconfig as config
-from volumedata import volume_data
+from volumedata import series_store
+
+DEFAULT_BLOCK_ROWS = 512
+
+# Training polygons used for labelling
+LAND_POLYGONS = config.LAND_POLYGON_TEXANA
+WATER_POLYGONS = config.WATER_POLYGON_TEXANA
+BORDER_POLYGON = config.BORDER_POLYGON_TEXANA
+# LAND_POLYGONS = config.LAND_POLYGON
+# WATER_POLYGONS = config.WATER_POLYGON
+# BORDER_POLYGON = config.BORDER_POLYGON
+
+# Directory of the cached labelled features. None stores them in a labelled_cache folder next to the product folders
+LABELLED_CACHE_DIR = None
 
 
 def convert_wkt_to_polygon(wkt_in):
@@ -32,16 +47,52 @@ def create_labels(land_len, water_len):
     return pd.DataFrame(target_labels, columns=['label'])
 
 
+def list_band_files(path):
+    """Returns the .img band files of a product folder in a stable (sorted) order"""
+    return sorted(f for f in os.listdir(path) if f.endswith('.img'))
+
+
+def open_band_rasters(path):
+    return [rasterio.open(os.path.join(path, f)) for f in list_band_files(path)]
+
+
+def read_features(rasters, window=None):
+    """
+    Reads every band (or one window of every band) straight into a single preallocated float32 array and
+    returns it as a (pixels, bands) DataFrame without copying. The bands are stored band-major so that each
+    band is read in place, the DataFrame is a transposed view of it.
+    """
+    if window is None:
+        height, width = rasters[0].height, rasters[0].width
+    else:
+        height, width = int(window.height), int(window.width)
+    features = np.empty((len(rasters), height * width), dtype=np.float32)
+    for band_idx, raster in enumerate(rasters):
+        raster.read(1, window=window, out=features[band_idx].reshape(height, width))
+    return pd.DataFrame(features.T, columns=[raster.descriptions[0] for raster in rasters], copy=False)
+
+
 # Get water and land mask to extract ground truths
 def extract_features_from(path):
-    features = []
-    for file in os.listdir(path):
-        if file.endswith('.img'):
-            p = rasterio.open(path + '\\' + file)
-            prdt_arr = p.read(1)
-            df = pd.DataFrame(prdt_arr.flatten(), columns=[p.descriptions[0]])
-            features.append(df)
-    return pd.concat(features, axis=1, sort=False)
+    rasters = open_band_rasters(path)
+    try:
+        return read_features(rasters)
+    finally:
+        for raster in rasters:
+            raster.close()
+
+
+def iter_feature_blocks(path, block_rows=DEFAULT_BLOCK_ROWS):
+    """Yields (window, features) for consecutive blocks of rows so that a scene never has to fit in memory"""
+    rasters = open_band_rasters(path)
+    try:
+        height, width = rasters[0].height, rasters[0].width
+        for row_off in range(0, height, block_rows):
+            window = Window(0, row_off, width, min(block_rows, height - row_off))
+            yield window, read_features(rasters, window)
+    finally:
+        for raster in rasters:
+            raster.close()
 
 
 def classify_border(border_array):
@@ -55,64 +106,126 @@ def classify_border(border_array):
     return thres_img
 
 
+def split_border_pixels(border_arr, thres_mask):
+    """Splits the border window into land and water pixels using the threshold mask (1 = land, 0 = water)"""
+    is_land = thres_mask == 1
+    return border_arr[is_land], border_arr[~is_land]
+
+
+# Pixel windows of the training polygons, keyed by the raster grid and the polygons
+_window_index_cache = {}
+
+
+def get_polygon_window_index(raster, land_wkts, water_wkts, border_wkt):
+    """
+    Computes the pixel windows and inside-polygon masks of the training polygons once per raster grid.
+    Each polygon entry holds the slices into the union window of all polygons and a mask that is True for pixels
+    lying outside the polygon, so that every band only needs to be read once with the union window.
+    """
+    key = (str(raster.crs), tuple(raster.transform), raster.width, raster.height,
+           tuple(land_wkts), tuple(water_wkts), border_wkt)
+    if key in _window_index_cache:
+        return _window_index_cache[key]
+
+    polygon_windows = {'land': [], 'water': [], 'border': []}
+    for name, wkts in (('land', land_wkts), ('water', water_wkts), ('border', [border_wkt])):
+        for wkt in wkts:
+            outside, out_transform, window = mask.raster_geometry_mask(
+                raster, [convert_wkt_to_polygon(wkt)], all_touched=True, crop=True)
+            polygon_windows[name].append((window, outside))
+
+    all_windows = [window for entries in polygon_windows.values() for window, outside in entries]
+    bounds = union(*all_windows)
+    row_start, col_start = int(bounds.row_off), int(bounds.col_off)
+    window_index = {'window': bounds}
+    for name, entries in polygon_windows.items():
+        window_index[name] = []
+        for window, outside in entries:
+            rows = slice(int(window.row_off) - row_start, int(window.row_off) - row_start + outside.shape[0])
+            cols = slice(int(window.col_off) - col_start, int(window.col_off) - col_start + outside.shape[1])
+            window_index[name].append(((rows, cols), outside))
+    _window_index_cache[key] = window_index
+    return window_index
+
+
+def read_polygon_pixels(window_arr, polygon_entry, nodata):
+    """Cuts one polygon out of an array read with the union window, filling pixels outside the polygon with nodata"""
+    slices, outside = polygon_entry
+    return np.where(outside, nodata, window_arr[slices])
+
+
 def get_labelled_features_as_df(path):
-    df = pd.DataFrame()
+    with rasterio.open(os.path.join(path, 'Sigma0_VV_GLCMMean.img')) as mean_raster:
+        window_index = get_polygon_window_index(mean_raster, LAND_POLYGONS, WATER_POLYGONS, BORDER_POLYGON)
+        # obtain threshold mask
+        mean_nodata = mean_raster.nodata if mean_raster.nodata is not None else 0
+        mean_arr = mean_raster.read(1, window=window_index['window'])
+        thres_mask = classify_border(read_polygon_pixels(mean_arr, window_index['border'][0], mean_nodata))
+
+    columns = {}
     total_land_samples = 0
     total_water_samples = 0
-    for f in os.listdir(path):
-        if f.endswith('.img'):
-            raster = rasterio.open(path + '\\' + f)
-            land_arr = np.empty(0)
-            water_arr = np.empty(0)
-            # obtain threshold mask
-            mean_raster = rasterio.open(path + '\\Sigma0_VV_GLCMMean.img')
-            border_polygon = convert_wkt_to_polygon(config.BORDER_POLYGON_TEXANA)
-            # border_polygon = convert_wkt_to_polygon(config.BORDER_POLYGON)
-            [border_arr], border_xy = mask.mask(dataset=mean_raster, shapes=[border_polygon], all_touched=True, crop=True)
-            thres_mask = classify_border(border_arr)
-            for land_wkt, water_wkt in zip(config.LAND_POLYGON_TEXANA, config.WATER_POLYGON_TEXANA):
-            # for land_wkt, water_wkt in zip(config.LAND_POLYGON, config.WATER_POLYGON):
-                land_polygon = convert_wkt_to_polygon(land_wkt)
-                water_polygon = convert_wkt_to_polygon(water_wkt)
-
-                [land_raster], land_xy = mask.mask(dataset=raster, shapes=[land_polygon], all_touched=True, crop=True)
-                [water_raster], water_xy = mask.mask(dataset=raster, shapes=[water_polygon], all_touched=True, crop=True)
-                land_arr = np.concatenate((land_arr, land_raster.flatten()))
-                water_arr = np.concatenate((water_arr, water_raster.flatten()))
-            border_polygon = convert_wkt_to_polygon(config.BORDER_POLYGON_TEXANA)
-            # border_polygon = convert_wkt_to_polygon(config.BORDER_POLYGON)
-            [border_arr], border_xy = mask.mask(dataset=raster, shapes=[border_polygon], all_touched=True, crop=True)
-
-            border_land = []
-            border_water = []
-            for i in range(len(border_arr)):
-                for j in range(len(border_arr[0])):
-                    if thres_mask[i][j] == 1:  # land
-                        border_land.append(border_arr[i][j])
-                    else:  # water
-                        border_water.append(border_arr[i][j])
-            land_1d = np.concatenate((land_arr.flatten(), border_land))
-            water_1d = np.concatenate((water_arr.flatten(), border_water))
-            land_1d = land_1d.tolist()
-            water_1d = water_1d.tolist()
-
-            total_land_samples = len(land_1d)
-            total_water_samples = len(water_1d)
-            land_water_arr = land_1d + water_1d
-            df = pd.concat([df, pd.DataFrame(land_water_arr, columns=[raster.descriptions[0]])], axis=1, sort=False)
-    label_df = create_labels(total_land_samples, total_water_samples)
-    df = pd.concat([df, label_df], axis=1, sort=False)
-    min_num_samples = min(total_water_samples, total_land_samples)
-    if total_land_samples > min_num_samples:
-        to_remove = np.random.choice(df[df['label'] == config.LAND].index, size=total_land_samples - min_num_samples, replace=False)
-    else:
-        to_remove = np.random.choice(df[df['label'] == config.WATER].index, size=total_water_samples - min_num_samples, replace=False)
-    df.drop(to_remove)
+    for f in list_band_files(path):
+        with rasterio.open(os.path.join(path, f)) as raster:
+            nodata = raster.nodata if raster.nodata is not None else 0
+            window_arr = raster.read(1, window=window_index['window'])
+            description = raster.descriptions[0]
+        land_parts = [read_polygon_pixels(window_arr, entry, nodata).ravel() for entry in window_index['land']]
+        water_parts = [read_polygon_pixels(window_arr, entry, nodata).ravel() for entry in window_index['water']]
+        border_arr = read_polygon_pixels(window_arr, window_index['border'][0], nodata)
+        border_land, border_water = split_border_pixels(border_arr, thres_mask)
+        land_1d = np.concatenate(land_parts + [border_land])
+        water_1d = np.concatenate(water_parts + [border_water])
+
+        total_land_samples = land_1d.size
+        total_water_samples = water_1d.size
+        columns[description] = np.concatenate((land_1d, water_1d))
+    df = pd.DataFrame(columns)
+    df['label'] = create_labels(total_land_samples, total_water_samples)['label']
+    return df
+
+
+def get_labelled_cache_key(path):
+    """Identifies the labelled features of a product by its folder, the mtime and size of its bands and the polygons"""
+    band_stats = [(f, os.stat(os.path.join(path, f))) for f in list_band_files(path)]
+    key = {'path': os.path.abspath(path),
+           'bands': [[f, stat.st_mtime_ns, stat.st_size] for f, stat in band_stats],
+           'land': list(LAND_POLYGONS),
+           'water': list(WATER_POLYGONS),
+           'border': BORDER_POLYGON}
+    return hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+
+
+def get_cached_labelled_features_as_df(path, cache_dir=None):
+    """
+    Same as get_labelled_features_as_df, but the result is stored in a compressed .npz per product folder and
+    reused until a band file or the training polygons change
+    """
+    if cache_dir is None:
+        cache_dir = LABELLED_CACHE_DIR
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(path)), 'labelled_cache')
+    cache_file = os.path.join(cache_dir, hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest() + '.npz')
+    key = get_labelled_cache_key(path)
+    if os.path.exists(cache_file):
+        with np.load(cache_file, allow_pickle=False) as cached:
+            if str(cached['key']) == key:
+                df = pd.DataFrame(cached['features'], columns=cached['columns'].tolist())
+                df['label'] = cached['labels']
+                return df
+
+    df = get_labelled_features_as_df(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = cache_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        np.savez_compressed(f, key=key, columns=np.array(df.columns[:-1], dtype=str),
+                            features=df.iloc[:, :-1].to_numpy(), labels=df['label'].to_numpy())
+    os.replace(tmp_file, cache_file)
     return df
 
 
 def get_labelled_data(path):
-    feature_bands = [get_labelled_features_as_df(path + '\\' + f) for f in os.listdir(path) if f.endswith('.img')]
+    feature_bands = [get_labelled_features_as_df(os.path.join(path, f)) for f in os.listdir(path) if f.endswith('.img')]
     return pd.concat(feature_bands, axis=1, sort=False)
 
 
@@ -132,10 +245,10 @@ def get_area_vol_as_df(mask_path):
     for file_name in sorted_files:
         area = convert_wkt_from_dd_to_m_to_polygon(mask_dict[file_name]).area
         date = datetime.strptime(file_name.split('_')[0], config.DATE_FORMAT).date()
-        vol = volume_data.get_volume_for_date(date)
-        data.append([date, area, vol])
+        data.append([date, area])
 
-    df = pd.DataFrame(data, columns=['date', 'area', 'volume'])
+    df = pd.DataFrame(data, columns=['date', 'area'])
+    df['volume'] = series_store.get_volumes_for_dates(df['date'].tolist())
     return df
 
 
@@ -157,7 +270,7 @@ def get_drought_df(mask_path):
 
     # inflows = volume_data.get_inflow_for_dates(date_list[0].year, date_list)
     # temperatures = volume_data.get_temp_for_dates(date_list)
-    volumes = volume_data.get_volume_for_dates(date_list[0].year, date_list)
+    volumes = series_store.get_volumes_for_dates(date_list)
     data = zip(date_list, volumes, area_list)
     # data = zip(date_list, volumes, area_list, inflows, temperatures)
 
@@ -0,0 +1,221 @@
+"""
+Tests of the local series store against synthetic stand-ins for the thaiwater.net responses. api_client.fetch is
+replaced by a stand-in that serves the JSON files of tests/fixtures/thaiwater, so the tests never go to the network.
+The fixtures are not captured from the API but reproduce the layout and quirks of its payloads: the three most recent
+years on the time axis of the current year, unpublished days as null, left out days and extra series without a year.
+"""
+import json
+import os
+from contextlib import closing
+from datetime import date, datetime, timedelta, timezone
+
+import pandas as pd
+import pytest
+
+from volumedata import api_client, series_store, volume_data
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'thaiwater')
+HISTORICAL_DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'volumedata',
+                                    'lam_chae_info.json')
+API_TIMEZONE = timezone(timedelta(hours=7))
+DAM = volume_data.LAM_CHAE_DAM_ID
+STATION = volume_data.NAKHON_RATCHASIMA_STATION_CODE
+
+
+def load_fixture(file_name):
+    with open(os.path.join(FIXTURE_DIR, file_name), 'rb') as f:
+        return f.read()
+
+
+class FixtureApi:
+    """Serves the fixture of every request and keeps the requests it was asked for"""
+
+    def __init__(self):
+        self.fixtures = {'volume': 'volume_dam17_20200701.json',
+                         'inflow': 'inflow_dam17_20200701.json',
+                         'rainfall': 'rainfall_431201_201901.json',
+                         'temperature': 't_dry_431201_201901.json'}
+        self.calls = []
+
+    def fetch(self, method, url, params=None, ttl=api_client.CACHE_TTL, **kwargs):
+        if 'generate_rid_data' in url:
+            name = {0: 'volume', 1: 'inflow'}[params['rtype']]
+        elif 'type=t_dry' in url:
+            name = 'temperature'
+        else:
+            name = 'rainfall'
+        self.calls.append((name, params))
+        return load_fixture(self.fixtures[name])
+
+
+@pytest.fixture
+def api(monkeypatch):
+    fixture_api = FixtureApi()
+    monkeypatch.setattr(api_client, 'fetch', fixture_api.fetch)
+    return fixture_api
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    return str(tmp_path / 'series.sqlite')
+
+
+def fixture_value(entries, selected_date):
+    """Value of a [[time stamp, value], ...] series on the month and day of the date, in Thai time"""
+    for time_stamp, value in entries:
+        stamp_date = datetime.fromtimestamp(time_stamp / 1000, API_TIMEZONE)
+        if (stamp_date.month, stamp_date.day) == (selected_date.month, selected_date.day):
+            return value
+    raise KeyError(selected_date)
+
+
+def fixture_series(file_name, text):
+    """Values of the series of a fixture response whose text is the year (or station code)"""
+    content = json.loads(load_fixture(file_name))
+    return next(entry['values'] for entry in content['graphset'][0]['series'] if entry.get('text') == str(text))
+
+
+def historical_series(year, series_name):
+    with open(HISTORICAL_DATA_PATH) as json_file:
+        return json.load(json_file)[str(year)][series_name]
+
+
+def test_first_lookup_syncs_the_api_and_historical_years(api, store_path):
+    dates = [date(2017, 1, 20), date(2018, 1, 15), date(2019, 2, 1), date(2020, 2, 29), date(2020, 6, 30)]
+    volumes = series_store.get_volumes_for_dates(dates, path=store_path)
+
+    fixture = api.fixtures['volume']
+    assert volumes == [fixture_value(historical_series(2017, 'volume'), dates[0]),
+                       fixture_value(fixture_series(fixture, 2018), dates[1]),
+                       fixture_value(fixture_series(fixture, 2019), dates[2]),
+                       fixture_value(fixture_series(fixture, 2020), dates[3]),
+                       fixture_value(fixture_series(fixture, 2020), dates[4])]
+    # 2017 comes from lam_chae_info.json, 2018-2020 from a single response
+    assert [params['xyear[]'] for name, params in api.calls] == [2020]
+
+
+def test_repeat_lookup_reads_the_store_only(api, store_path):
+    dates = [date(2018, 1, 1), date(2019, 1, 4), date(2020, 3, 15)]
+    first = series_store.get_volumes_for_dates(dates, path=store_path)
+    api.calls.clear()
+
+    assert series_store.get_volumes_for_dates(dates, path=store_path) == first
+    assert series_store.get_volumes_for_dates([date(2019, 2, 28), date(2018, 2, 1)], path=store_path) == [
+        fixture_value(fixture_series(api.fixtures['volume'], 2019), date(2019, 2, 28)),
+        fixture_value(fixture_series(api.fixtures['volume'], 2018), date(2018, 2, 1))]
+    assert api.calls == []
+
+
+def test_dates_without_a_value_are_not_fetched_again(api, store_path):
+    # the fixture is the response of 1 July 2020, when the volumes of 2020 were published up to 30 June. 9 Aug 2019 is
+    # published as null and 2 Oct 2019 is left out
+    dates = [date(2019, 8, 9), date(2019, 10, 2), date(2020, 7, 15)]
+    assert series_store.get_volumes_for_dates(dates, path=store_path) == [None, None, None]
+    api.calls.clear()
+
+    assert series_store.get_volumes_for_dates(dates, path=store_path) == [None, None, None]
+    series_store.sync_missing_years([2019, 2020], names=(series_store.VOLUME,), path=store_path)
+    assert api.calls == []
+
+
+def test_year_still_being_published_is_synced_again(api, store_path):
+    assert series_store.get_volumes_for_dates([date(2020, 7, 15)], path=store_path) == [None]
+    with closing(series_store.connect(store_path)) as conn:
+        # as if the store had been synced on 1 July 2020
+        series_store.put_synced_years(conn, DAM, series_store.VOLUME, [2020], today=date(2020, 7, 1))
+
+    api.fixtures['volume'] = 'volume_dam17_20201001.json'
+    api.calls.clear()
+    assert series_store.get_volumes_for_dates([date(2020, 6, 30), date(2020, 7, 15)], path=store_path) == [
+        fixture_value(fixture_series(api.fixtures['volume'], 2020), date(2020, 6, 30)),
+        fixture_value(fixture_series(api.fixtures['volume'], 2020), date(2020, 7, 15))]
+    assert len(api.calls) == 1
+
+
+def test_years_to_sync(store_path):
+    with closing(series_store.connect(store_path)) as conn:
+        series_store.put_synced_years(conn, DAM, series_store.VOLUME, [2018, 2019], today=date(2020, 1, 1))
+        series_store.put_synced_years(conn, DAM, series_store.VOLUME, [2020], today=date(2020, 7, 1))
+
+        def years_to_sync(today):
+            return series_store.get_years_to_sync(conn, DAM, series_store.VOLUME, [2017, 2018, 2019, 2020, 2021],
+                                                  today=today)
+
+        # 2020 is still being published, but was synced today
+        assert years_to_sync(date(2020, 7, 1)) == [2017, 2021]
+        assert years_to_sync(date(2020, 7, 2)) == [2017, 2020, 2021]
+        assert series_store.get_years_to_sync(conn, DAM, series_store.INFLOW, [2019]) == [2019]
+
+
+def test_common_years_are_aligned_by_month_and_day(api, store_path):
+    # 9 Aug 2019 is published as null and 2 Oct 2019 is left out of the response
+    dates = [date(2017, 12, 30), date(2018, 12, 31), date(2019, 3, 1), date(2019, 8, 9), date(2019, 10, 2),
+             date(2019, 10, 4), date(2019, 12, 31)]
+    volumes = series_store.get_volumes_for_dates(dates, path=store_path)
+
+    fixture = api.fixtures['volume']
+    assert volumes == [fixture_value(historical_series(2017, 'volume'), dates[0]),
+                       fixture_value(fixture_series(fixture, 2018), dates[1]),
+                       fixture_value(fixture_series(fixture, 2019), dates[2]),
+                       None,
+                       None,
+                       fixture_value(fixture_series(fixture, 2019), dates[5]),
+                       fixture_value(fixture_series(fixture, 2019), dates[6])]
+
+
+def test_sync_reservoir_series_stores_volume_and_inflow(api, store_path):
+    with closing(series_store.connect(store_path)) as conn:
+        series_store.sync_reservoir_series(conn, [2019])
+
+    assert sorted(name for name, params in api.calls) == ['inflow', 'volume']
+    selected_date = date(2019, 1, 31)
+    assert series_store.get_values_for_dates([selected_date], series_store.INFLOW, path=store_path,
+                                             sync_missing=False) == [
+        fixture_value(fixture_series(api.fixtures['inflow'], 2019), selected_date)]
+
+
+def test_climate_series(api, store_path):
+    with closing(series_store.connect(store_path)) as conn:
+        series_store.sync_climate_series(conn, date(2019, 1, 1), date(2019, 1, 31), STATION)
+
+    dates = [date(2019, 1, 1), date(2019, 1, 15), date(2019, 1, 31)]
+    rainfall = series_store.get_values_for_dates(dates, series_store.RAINFALL, STATION, store_path)
+    temperature = series_store.get_values_for_dates(dates, series_store.TEMPERATURE, STATION, store_path)
+
+    assert rainfall == [fixture_value(fixture_series(api.fixtures['rainfall'], STATION), d) for d in dates]
+    assert temperature == [fixture_value(fixture_series(api.fixtures['temperature'], STATION), d) for d in dates]
+    # 5 Jan is published as null and 20 Jan is left out of the responses
+    assert series_store.get_values_for_dates([date(2019, 1, 5), date(2019, 1, 20)], series_store.RAINFALL, STATION,
+                                             store_path) == [None, None]
+    # the climate series are never synced on lookup
+    api.calls.clear()
+    assert series_store.get_values_for_dates([date(2019, 2, 1)], series_store.RAINFALL, STATION, store_path) == [None]
+    assert api.calls == []
+
+
+def test_request_spans():
+    assert volume_data.get_request_spans([2014, 2015, 2018, 2019, 2020, 2021]) == [(2021, [2021, 2020, 2019]),
+                                                                                  (2018, [2018]),
+                                                                                  (2015, [2015, 2014])]
+    assert volume_data.get_request_spans([]) == []
+
+
+def test_fetch_bulk_requests_every_span_once(api):
+    table = volume_data.fetch_bulk([DAM], range(2016, 2021))
+
+    assert sorted((name, params['xyear[]']) for name, params in api.calls) == [('inflow', 2020), ('volume', 2020)]
+    assert table[(DAM, volume_data.VOLUME)][pd.Timestamp(2018, 5, 1)] == fixture_value(
+        fixture_series(api.fixtures['volume'], 2018), date(2018, 5, 1))
+    assert table[(DAM, volume_data.INFLOW)][pd.Timestamp(2016, 5, 1)] == fixture_value(
+        historical_series(2016, 'inflow'), date(2016, 5, 1))
+
+
+def test_years_left_out_of_a_response_are_requested_on_their_own(api):
+    # the responses only hold 2018-2020
+    table = volume_data.fetch_bulk([DAM], [2020, 2021, 2022], [volume_data.VOLUME])
+
+    assert [params['xyear[]'] for name, params in api.calls] == [2022, 2021]
+    volumes = table[(DAM, volume_data.VOLUME)]
+    assert volumes[pd.Timestamp(2020, 5, 1)] == fixture_value(fixture_series(api.fixtures['volume'], 2020),
+                                                              date(2020, 5, 1))
+    assert volumes['2021':'2022'].isna().all()
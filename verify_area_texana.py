@@ -24,8 +24,13 @@ def convert_wkt_from_dd_to_m_to_polygon(wkt_in):
     return transform(projection, wkt)
 
 
+def get_area(value):
+    """area.json holds the area, or {"area": ..., "shoreline_length": ...} when the shoreline is reported"""
+    return value['area'] if isinstance(value, dict) else value
+
+
 with open("D:\\Texana\\Processing\\Area\\area.json", 'r', encoding='utf-8') as f:
-    mask_wkt_json = json.load(f)
+    mask_wkt_json = {key: get_area(value) for key, value in json.load(f).items()}
 df = pd.read_csv("volumedata/texana.csv", parse_dates=['date'])
 # print(df)
 date_list = []
@@ -0,0 +1,118 @@
+"""
+Shared HTTP client of the thaiwater.net API: one pooled requests.Session with timeouts and retries, and a response cache
+held in memory (LRU) and on disk, both evicted after a TTL, so that repeated runs fetch every series at most once a day
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'http_cache')
+CACHE_TTL = 24 * 60 * 60
+MAX_MEMORY_ENTRIES = 128
+# (connect, read) timeouts in seconds
+TIMEOUT = (10, 60)
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 1.0
+
+_session = None
+_session_lock = threading.Lock()
+# cache key -> (time fetched, response content)
+_memory_cache = OrderedDict()
+_memory_cache_lock = threading.Lock()
+
+
+def get_session():
+    """Returns the shared session, retrying connection errors and 429/5xx responses with exponential backoff"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR, status_forcelist=(429, 500, 502, 503, 504),
+                          allowed_methods=None, raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+
+def get_cache_key(method, url, params=None):
+    key = json.dumps([method.upper(), url, sorted((params or {}).items())], default=str)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _get_cached(key, ttl):
+    now = time.time()
+    with _memory_cache_lock:
+        if key in _memory_cache:
+            fetched, content = _memory_cache[key]
+            if now - fetched < ttl:
+                _memory_cache.move_to_end(key)
+                return content
+            del _memory_cache[key]
+
+    cache_file = os.path.join(CACHE_DIR, key)
+    if os.path.exists(cache_file) and now - os.path.getmtime(cache_file) < ttl:
+        with open(cache_file, 'rb') as f:
+            content = f.read()
+        _put_memory(key, os.path.getmtime(cache_file), content)
+        return content
+    return None
+
+
+def _put_memory(key, fetched, content):
+    with _memory_cache_lock:
+        _memory_cache[key] = (fetched, content)
+        _memory_cache.move_to_end(key)
+        while len(_memory_cache) > MAX_MEMORY_ENTRIES:
+            _memory_cache.popitem(last=False)
+
+
+def _put_cached(key, content):
+    _put_memory(key, time.time(), content)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    cache_file = os.path.join(CACHE_DIR, key)
+    tmp_file = f'{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_file, cache_file)
+
+
+def fetch(method, url, params=None, ttl=CACHE_TTL, **kwargs):
+    """
+    Returns the content of a successful (200) response, from the cache when it is younger than ttl seconds.
+    Returns None when the request fails, failed responses are not cached.
+    """
+    key = get_cache_key(method, url, params)
+    content = _get_cached(key, ttl)
+    if content is not None:
+        return content
+
+    try:
+        response = get_session().request(method, url, params=params, timeout=TIMEOUT, **kwargs)
+    except requests.RequestException as e:
+        logger.error(f"{method} {url} failed: {e}")
+        return None
+    if response.status_code != 200:
+        logger.error(f"{method} {url} returned {response.status_code}")
+        return None
+    _put_cached(key, response.content)
+    return response.content
+
+
+def clear_cache():
+    with _memory_cache_lock:
+        _memory_cache.clear()
+    if os.path.isdir(CACHE_DIR):
+        for file_name in os.listdir(CACHE_DIR):
+            os.remove(os.path.join(CACHE_DIR, file_name))
@@ -0,0 +1,149 @@
+"""
+Local SQLite store of the reservoir (volume, inflow) and climate (rainfall, temperature) daily series, so that lookups
+by date are indexed local reads instead of API calls. The store is filled by the sync functions, either up front
+(python -m volumedata.series_store --years 2016 2017 2018 2019 2020) or on demand for the years a lookup needs that were
+never synced, or were still being published at their last sync (re-synced at most once a day).
+"""
+import argparse
+import logging
+import os
+import sqlite3
+from contextlib import closing
+from datetime import date, timedelta
+
+import pandas as pd
+
+from volumedata import volume_data
+
+logger = logging.getLogger(__name__)
+
+STORE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'series.sqlite')
+
+VOLUME = volume_data.VOLUME
+INFLOW = volume_data.INFLOW
+RAINFALL = 'rainfall'
+TEMPERATURE = 'temperature'
+
+
+def connect(path=None):
+    conn = sqlite3.connect(path or STORE_PATH)
+    conn.execute('CREATE TABLE IF NOT EXISTS series ('
+                 'source TEXT NOT NULL, name TEXT NOT NULL, date TEXT NOT NULL, value REAL, '
+                 'PRIMARY KEY (source, name, date)) WITHOUT ROWID')
+    conn.execute('CREATE TABLE IF NOT EXISTS synced_years ('
+                 'source TEXT NOT NULL, name TEXT NOT NULL, year INTEGER NOT NULL, synced TEXT NOT NULL, '
+                 'PRIMARY KEY (source, name, year)) WITHOUT ROWID')
+    return conn
+
+
+def put_series(conn, source, name, dates, values):
+    """Inserts or replaces the (date, value) pairs of one series of a dam or station"""
+    rows = [(str(source), name, d.isoformat(), None if pd.isna(v) else float(v)) for d, v in zip(dates, values)]
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO series (source, name, date, value) VALUES (?, ?, ?, ?)', rows)
+    return len(rows)
+
+
+def get_series(conn, source, name, start=None, end=None):
+    """Returns the series between start and end (inclusive) as a pandas Series indexed by date"""
+    start = (start or date.min).isoformat()
+    end = (end or date.max).isoformat()
+    df = pd.read_sql_query('SELECT date, value FROM series WHERE source = ? AND name = ? AND date BETWEEN ? AND ? '
+                           'ORDER BY date', conn, params=(str(source), name, start, end), parse_dates=['date'])
+    return df.set_index('date')['value']
+
+
+def put_synced_years(conn, source, name, years, today=None):
+    synced = (today or date.today()).isoformat()
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO synced_years (source, name, year, synced) VALUES (?, ?, ?, ?)',
+                         [(str(source), name, int(year), synced) for year in years])
+
+
+def get_years_to_sync(conn, source, name, years, today=None):
+    """
+    The years that were never synced, or that were synced before their last day was published (the value of a day is
+    only published once the day is over) and not yet today. Days without a value in a synced year are not fetched again
+    """
+    today = today or date.today()
+    rows = conn.execute('SELECT year, synced FROM synced_years WHERE source = ? AND name = ?',
+                        (str(source), name)).fetchall()
+    synced = {year: date.fromisoformat(synced_date) for year, synced_date in rows}
+    return sorted(year for year in set(years)
+                  if year not in synced or (synced[year] <= date(year, 12, 31) and synced[year] < today))
+
+
+def sync_reservoir_series(conn, years, dam=volume_data.LAM_CHAE_DAM_ID, names=(VOLUME, INFLOW)):
+    """
+    Fetches the volume and/or inflow of the years concurrently (with the historical json fallback) and stores them.
+    The years that came back without any value (failed requests) are not marked as synced, so they are tried again
+    """
+    table = volume_data.fetch_bulk([dam], years, names)
+    for (table_dam, name), series in table.items():
+        series = series.dropna()
+        put_series(conn, table_dam, name, series.index.date, series.to_numpy())
+        put_synced_years(conn, table_dam, name, set(series.index.year) & set(years))
+        logger.info(f"Stored {len(series)} days of the {name} of dam {table_dam} for {sorted(set(years))}")
+
+
+def sync_missing_years(years, dam=volume_data.LAM_CHAE_DAM_ID, names=(VOLUME, INFLOW), path=None):
+    """Syncs the years of the reservoir series that get_years_to_sync returns, all of them in one concurrent fetch"""
+    with closing(connect(path)) as conn:
+        missing_years = {year for name in names for year in get_years_to_sync(conn, dam, name, years)}
+        if missing_years:
+            sync_reservoir_series(conn, sorted(missing_years), dam, names)
+
+
+def sync_climate_series(conn, start, end, station=volume_data.NAKHON_RATCHASIMA_STATION_CODE):
+    """Fetches the daily rainfall and temperature between start and end from the API and stores them"""
+    rainfall = volume_data.get_daily_cumulative_rainfall(start, end + timedelta(days=1), station)
+    if rainfall is not None:
+        put_series(conn, station, RAINFALL, [d.date() for d in rainfall.keys()], rainfall.values())
+    temperature = volume_data.get_daily_temperature(start, end + timedelta(days=1), station)
+    if temperature is not None:
+        put_series(conn, station, TEMPERATURE, temperature.keys(), temperature.values())
+
+
+def get_values_for_dates(dates, name=VOLUME, source=volume_data.LAM_CHAE_DAM_ID, path=None, sync_missing=True):
+    """
+    Returns the values of the series for every date (None where there is no value), with a single indexed range query.
+    For the reservoir series the years that get_years_to_sync returns are synced first when sync_missing is set, so a
+    date without a value in a synced year does not cause another fetch.
+    """
+    if len(dates) == 0:
+        return []
+    with closing(connect(path)) as conn:
+        if sync_missing and name in (VOLUME, INFLOW):
+            missing_years = get_years_to_sync(conn, source, name, {d.year for d in dates})
+            if missing_years:
+                sync_reservoir_series(conn, missing_years, source, names=(name,))
+        series = get_series(conn, source, name, min(dates), max(dates))
+    values = series.reindex(pd.to_datetime(list(dates)))
+    return [None if pd.isna(v) else v for v in values]
+
+
+def get_volumes_for_dates(dates, dam=volume_data.LAM_CHAE_DAM_ID, path=None):
+    """Volume (million cubic metres) of the dam for every date"""
+    return get_values_for_dates(dates, VOLUME, dam, path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Fills the local series store from the thaiwater.net API')
+    parser.add_argument('--years', type=int, nargs='+', default=[int(year) for year in volume_data.volume_keys])
+    parser.add_argument('--dam', type=int, default=volume_data.LAM_CHAE_DAM_ID)
+    parser.add_argument('--station', default=volume_data.NAKHON_RATCHASIMA_STATION_CODE)
+    parser.add_argument('--climate', action='store_true', help='also sync the daily rainfall and temperature')
+    parser.add_argument('--store', help='path of the SQLite store')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(name)s: %(message)s',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S')
+    args = parse_args()
+    with closing(connect(args.store)) as store:
+        sync_reservoir_series(store, args.years, args.dam)
+        if args.climate:
+            sync_climate_series(store, date(min(args.years), 1, 1), date(max(args.years), 12, 31), args.station)
@@ -1,17 +1,63 @@
+import calendar
 import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, date, timedelta
 
-import matplotlib.pyplot as plt
-import requests
-from pandas.plotting import register_matplotlib_converters
+import numpy as np
+import pandas as pd
+
+from volumedata import api_client
 
 vol_api_url_base = "http://www.thaiwater.net/DATA/REPORT/php/generate_rid_data.php?"
 climate_api_url_base = "https://www.thaiwater.net/graph/generate_data.php?type=rainfall_24hr&date=07&month=03&year=2020"
 volume_keys = ['2020', '2019', '2018']
 LAM_CHAE_DAM_ID = 17
 NAKHON_RATCHASIMA_STATION_CODE = '431201'
-with open('volumedata/lam_chae_info.json') as json_file:
-    older_lc_data = json.load(json_file)
+VOLUME = 'volume'
+INFLOW = 'inflow'
+# Maximum number of concurrent API requests of fetch_bulk
+MAX_CONCURRENT_REQUESTS = 4
+# Number of consecutive years in every response of the API: the requested year and the years before it
+API_YEARS_PER_RESPONSE = 3
+# Time zone of the time stamps of the API
+API_TIMEZONE = timezone(timedelta(hours=7))
+# Lam Chae series of the years that the API no longer serves
+HISTORICAL_DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lam_chae_info.json')
+
+logger = logging.getLogger(__name__)
+
+# (year, series name) -> (time stamps, values) arrays of the historical json, loaded on first use
+_historical_arrays = None
+_historical_arrays_lock = threading.Lock()
+
+
+def get_historical_arrays():
+    """
+    Returns the series of lam_chae_info.json as {(year, series name): (int64 time stamps, float64 values)}. The json is
+    only read and converted the first time, so importing this module does not touch the file.
+    """
+    global _historical_arrays
+    with _historical_arrays_lock:
+        if _historical_arrays is None:
+            with open(HISTORICAL_DATA_PATH) as json_file:
+                older_lc_data = json.load(json_file)
+            arrays = {}
+            for year, year_data in older_lc_data.items():
+                for series_name, entries in year_data.items():
+                    entries = np.array(entries, dtype=float).reshape(-1, 2)
+                    arrays[(year, series_name)] = (entries[:, 0].astype(np.int64), entries[:, 1])
+            _historical_arrays = arrays
+        return _historical_arrays
+
+
+def get_historical_response(series_name):
+    """The historical years of a series in the response format of the API ({year: {'time': [...], 'values': [...]}})"""
+    return {year: {"time": times.tolist(), "values": values.tolist()}
+            for (year, name), (times, values) in sorted(get_historical_arrays().items(), reverse=True)
+            if name == series_name}
 
 
 def get_volume_data(dam_id, year):
@@ -19,9 +65,9 @@ def get_volume_data(dam_id, year):
     Hence 2017 is data is stored as 2-d array in basicconfig.py"""
     api_url = vol_api_url_base + 'dam={}'.format(dam_id)
     params = {'rtype': 0, 'xyear[]': year}
-    response = requests.post(api_url, params=params)
-    if response.status_code == 200:
-        content = json.loads(response.content.decode('utf-8'))
+    response_content = api_client.fetch('POST', api_url, params=params)
+    if response_content is not None:
+        content = json.loads(response_content.decode('utf-8'))
         series = content['graphset'][0]['series']
         processed_response = {}
         for entry in series:
@@ -29,19 +75,7 @@ def get_volume_data(dam_id, year):
                 vals = entry['values']
                 processed_response[entry['text']] = {"time": [element[0] for element in vals],
                                                      "values": [element[1] for element in vals]}
-        time_list = []
-        vals_list = []
-        for entry in older_lc_data["2017"]["volume"]:
-            time_list.append(entry[0])
-            vals_list.append(entry[1])
-        processed_response['2017'] = {"time": time_list, "values": vals_list}
-
-        time_list = []
-        vals_list = []
-        for entry in older_lc_data["2016"]["volume"]:
-            time_list.append(entry[0])
-            vals_list.append(entry[1])
-        processed_response['2016'] = {"time": time_list, "values": vals_list}
+        processed_response.update(get_historical_response(VOLUME))
         # note that timestamp in returned response is in unix timestamp format
         return processed_response
 
@@ -52,9 +86,9 @@ def get_volume_data(dam_id, year):
 def get_inflow_data(dam_id, year):
     api_url = vol_api_url_base + 'dam={}'.format(dam_id)
     params = {'rtype': 1, 'xyear[]': year}
-    response = requests.post(api_url, params=params)
-    if response.status_code == 200:
-        content = json.loads(response.content.decode('utf-8'))
+    response_content = api_client.fetch('POST', api_url, params=params)
+    if response_content is not None:
+        content = json.loads(response_content.decode('utf-8'))
         series = content['graphset'][0]['series']
         processed_response = {}
         for entry in series:
@@ -62,20 +96,7 @@ def get_inflow_data(dam_id, year):
                 vals = entry['values']
                 processed_response[entry['text']] = {"time": [element[0] for element in vals],
                                                      "values": [element[1] for element in vals]}
-        time_list = []
-        vals_list = []
-        for entry in older_lc_data["2017"]["inflow"]:
-            time_list.append(entry[0])
-            vals_list.append(entry[1])
-        processed_response['2017'] = {"time": time_list, "values": vals_list}
-        # note that timestamp in returned response is in unix timestamp format
-
-        time_list = []
-        vals_list = []
-        for entry in older_lc_data["2016"]["inflow"]:
-            time_list.append(entry[0])
-            vals_list.append(entry[1])
-        processed_response['2016'] = {"time": time_list, "values": vals_list}
+        processed_response.update(get_historical_response(INFLOW))
         # note that timestamp in returned response is in unix timestamp format
         return processed_response
 
@@ -83,6 +104,9 @@ def get_inflow_data(dam_id, year):
         return None
 
 
+SERIES_FETCHERS = {VOLUME: get_volume_data, INFLOW: get_inflow_data}
+
+
 def convert_unix_to_datetime(time):
     return datetime.utcfromtimestamp(time / 1000).replace(tzinfo=timezone.utc).astimezone(tz=None)
 
@@ -101,53 +125,160 @@ def create_timestamp(year: int):
     return dates
 
 
+def to_daily_series(year, year_data):
+    """
+    Puts the values of one year of an API response on a DatetimeIndex of that year. The API returns every year on the
+    time axis of the current year (in Thai time), so the values are aligned by the month and day of their time stamp:
+    a year on a leap-year axis loses 29 Feb when it is a common year instead of being shifted by a day.
+    """
+    axis = pd.to_datetime(year_data['time'], unit='ms', utc=True).tz_convert(API_TIMEZONE)
+    keep = np.full(len(axis), True) if calendar.isleap(year) else ~((axis.month == 2) & (axis.day == 29))
+    index = pd.to_datetime(pd.DataFrame({'year': year, 'month': axis.month[keep], 'day': axis.day[keep]}))
+    values = np.array(year_data['values'], dtype=float)[keep]
+    return pd.Series(values, index=pd.DatetimeIndex(index)).sort_index()
+
+
+def get_daily_series(fetch_data, years, dam=LAM_CHAE_DAM_ID):
+    """
+    Returns the daily series (volume or inflow, depending on fetch_data) of all the years on a single DatetimeIndex.
+    Every response also holds other years, so a year that came with an earlier response is not fetched again.
+    """
+    years = set(years)
+    parts = {}
+    for year in sorted(years):
+        if year in parts:
+            continue
+        response = fetch_data(dam, year)
+        if response is None:
+            continue
+        for year_key, year_data in response.items():
+            if int(year_key) in years and int(year_key) not in parts:
+                parts[int(year_key)] = to_daily_series(int(year_key), year_data)
+    if not parts:
+        return pd.Series(dtype=float, index=pd.DatetimeIndex([]))
+    return pd.concat([parts[year] for year in sorted(parts)])
+
+
+def lookup_dates(series, date_list):
+    """Values of a daily series for all the dates at once, nan where the series has no value"""
+    return series.reindex(pd.DatetimeIndex(pd.to_datetime(list(date_list))).normalize()).to_numpy()
+
+
+def to_optional(value):
+    return None if np.isnan(value) else value.item()
+
+
+def get_historical_data(dam_id, year, series_name):
+    """Series of a year that the API no longer serves, from lam_chae_info.json ({'time': array, 'values': array})"""
+    if dam_id != LAM_CHAE_DAM_ID:
+        return None
+    arrays = get_historical_arrays().get((str(year), series_name))
+    if arrays is None:
+        return None
+    times, values = arrays
+    return {"time": times, "values": values}
+
+
+def fetch_year_series(dam_id, year, series_name):
+    """One year of the volume or inflow of a dam, from the historical json when available and the API otherwise"""
+    year_data = get_historical_data(dam_id, year, series_name)
+    if year_data is None:
+        response = SERIES_FETCHERS[series_name](dam_id, year)
+        year_data = None if response is None else response.get(str(year))
+    if year_data is None:
+        logger.warning(f"No {series_name} data for dam {dam_id} in {year}")
+        return pd.Series(dtype=float, index=pd.DatetimeIndex([]))
+    return to_daily_series(year, year_data)
+
+
+def get_request_spans(years, span=API_YEARS_PER_RESPONSE):
+    """
+    Groups the years into the spans of consecutive years that a single response holds, latest first. Returns the year
+    to request and the years it covers for every span
+    """
+    spans = []
+    remaining = sorted(set(years), reverse=True)
+    while remaining:
+        request_year = remaining[0]
+        covered = [year for year in remaining if year > request_year - span]
+        spans.append((request_year, covered))
+        remaining = remaining[len(covered):]
+    return spans
+
+
+def fetch_span(dam_id, series_name, request_year, years):
+    """
+    The daily series of the years of one span ({year: series}) from a single request. A year that the response leaves
+    out is requested on its own
+    """
+    response = SERIES_FETCHERS[series_name](dam_id, request_year)
+    span_series = {}
+    for year in years:
+        year_data = None if response is None else response.get(str(year))
+        if year_data is not None:
+            span_series[year] = to_daily_series(year, year_data)
+        elif response is not None and year != request_year:
+            span_series[year] = fetch_year_series(dam_id, year, series_name)
+        else:
+            logger.warning(f"No {series_name} data for dam {dam_id} in {year}")
+            span_series[year] = pd.Series(dtype=float, index=pd.DatetimeIndex([]))
+    return span_series
+
+
+def fetch_bulk(dam_ids, years, series_names=(VOLUME, INFLOW), max_workers=MAX_CONCURRENT_REQUESTS):
+    """
+    Fetches the years of every dam and series concurrently, with at most max_workers requests in flight, and returns
+    them as one daily table covering all the years with a (dam, series) column per dam and series. The years in the
+    historical json are read from it, the others are requested once per span of years that a response holds
+    """
+    years = sorted(set(years))
+    parts = {}
+    spans = []
+    for dam_id in dam_ids:
+        for series_name in series_names:
+            part = parts.setdefault((dam_id, series_name), [])
+            api_years = []
+            for year in years:
+                if get_historical_data(dam_id, year, series_name) is not None:
+                    part.append(fetch_year_series(dam_id, year, series_name))
+                else:
+                    api_years.append(year)
+            spans.extend((dam_id, series_name, request_year, span_years)
+                         for request_year, span_years in get_request_spans(api_years))
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(spans)))) as executor:
+        span_series = list(executor.map(lambda span: fetch_span(*span), spans))
+
+    for (dam_id, series_name, request_year, span_years), series_by_year in zip(spans, span_series):
+        parts[(dam_id, series_name)].extend(series_by_year.values())
+    index = pd.date_range(f'{min(years)}-01-01', f'{max(years)}-12-31', freq='D')
+    table = pd.DataFrame({key: pd.concat(series_list).sort_index().reindex(index)
+                          for key, series_list in parts.items()}, index=index)
+    table.columns = pd.MultiIndex.from_tuples(table.columns, names=['dam', 'series'])
+    return table
+
+
 def get_volume_for_date(selected_date: date, dam=LAM_CHAE_DAM_ID):
-    year = selected_date.year
-    vol_data = get_volume_data(dam, year)
-    data_yr = vol_data[str(year)]
-    converted_time = create_timestamp(year)
-    vals = data_yr['values']
-    for i in range(len(converted_time)):
-        if converted_time[i].month == selected_date.month and converted_time[i].day == selected_date.day:
-            return vals[i]
+    volumes = get_daily_series(get_volume_data, [selected_date.year], dam)
+    return to_optional(lookup_dates(volumes, [selected_date])[0])
 
 
 def get_volume_for_dates(year, date_list, dam=LAM_CHAE_DAM_ID):
-    vol_data = get_volume_data(dam, year)
-    data_yr = vol_data[str(year)]
-    converted_dates = create_timestamp(year)
-    vol_map = {converted_dates[i]: data_yr['values'][i] for i in range(len(converted_dates))}
-
-    val_list = []
-    for d in date_list:
-        if d in vol_map:
-            val_list.append(vol_map[d])
-    return val_list
+    """Volumes of the dates that have one. The dates may span several years"""
+    volumes = get_daily_series(get_volume_data, {year} | {d.year for d in date_list}, dam)
+    values = lookup_dates(volumes, date_list)
+    return values[~np.isnan(values)].tolist()
 
 
 def get_inflow_for_date(selected_date: date, dam=LAM_CHAE_DAM_ID):
-    year = selected_date.year
-    inflow_data = get_inflow_data(dam, year)
-    data_yr = inflow_data[str(year)]
-    time = data_yr['time']
-    converted_time = create_timestamp(year)
-    vals = data_yr['values']
-    for i in range(len(converted_time)):
-        if converted_time[i].month == selected_date.month and converted_time[i].day == selected_date.day:
-            return vals[i]
+    inflows = get_daily_series(get_inflow_data, [selected_date.year], dam)
+    return to_optional(lookup_dates(inflows, [selected_date])[0])
 
 
 def get_inflow_for_dates(year, date_list, dam=LAM_CHAE_DAM_ID):
-    inflow_data = get_inflow_data(dam, year)
-    data_yr = inflow_data[str(year)]
-    converted_dates = create_timestamp(year)
-    inflow_map = {converted_dates[i]: data_yr['values'][i] for i in range(len(converted_dates))}
-
-    val_list = []
-    for d in date_list:
-        if d in inflow_map:
-            val_list.append(inflow_map[d])
-    return val_list
+    """Inflows of the dates that have one. The dates may span several years"""
+    inflows = get_daily_series(get_inflow_data, {year} | {d.year for d in date_list}, dam)
+    values = lookup_dates(inflows, date_list)
+    return values[~np.isnan(values)].tolist()
 
 
 def get_volume_for_year(year, dam=LAM_CHAE_DAM_ID):
@@ -164,12 +295,15 @@ def get_change_in_water_level(before_date, after_date):
     :param after_date: datetime date object
     :return: change in water volume in million cubic metres
     '''
-    before = get_volume_for_date(before_date)
-    after = get_volume_for_date(after_date)
+    volumes = get_daily_series(get_volume_data, [before_date.year, after_date.year])
+    before, after = lookup_dates(volumes, [before_date, after_date])
     return after - before
 
 
 def plot_volume_data(data_series, title, x_label, y_label):
+    import matplotlib.pyplot as plt
+    from pandas.plotting import register_matplotlib_converters
+
     time = []
     vals = []
     for year in data_series.keys():
@@ -192,9 +326,9 @@ def get_daily_cumulative_rainfall(start_date, end_date, area=NAKHON_RATCHASIMA_S
     start_date_str = start_date.strftime('%Y-%m-%d')
     end_date_str = end_date.strftime('%Y-%m-%d')
     url = climate_api_url_base + f'&type=rainfall_24hr&code={area}&sdate={start_date_str}&edate={end_date_str}'
-    response = requests.get(url, verify=False)
-    if response.status_code == 200:
-        content = json.loads(response.content.decode('utf-8'))
+    response_content = api_client.fetch('GET', url, verify=False)
+    if response_content is not None:
+        content = json.loads(response_content.decode('utf-8'))
         if content == 0:
             return None
         series = content['graphset'][0]['series']
@@ -212,9 +346,9 @@ def get_daily_temperature(start_date, end_date, area=NAKHON_RATCHASIMA_STATION_C
     start_date_str = start_date.strftime('%Y-%m-%d')
     end_date_str = end_date.strftime('%Y-%m-%d')
     url = climate_api_url_base + f'&type=t_dry&code={area}&sdate={start_date_str}&edate={end_date_str}'
-    response = requests.get(url, verify=False)
-    if response.status_code == 200:
-        content = json.loads(response.content.decode('utf-8'))
+    response_content = api_client.fetch('GET', url, verify=False)
+    if response_content is not None:
+        content = json.loads(response_content.decode('utf-8'))
         if content == 0:
             return None
         series = content['graphset'][0]['series']
@@ -227,49 +361,39 @@ def get_daily_temperature(start_date, end_date, area=NAKHON_RATCHASIMA_STATION_C
         return None
 
 
+def to_climate_series(climate_data):
+    """Daily climate values ({date or datetime: value}) as a series indexed by date"""
+    if not climate_data:
+        return pd.Series(dtype=float, index=pd.DatetimeIndex([]))
+    index = pd.DatetimeIndex([key.date() if isinstance(key, datetime) else key for key in climate_data.keys()])
+    series = pd.Series(np.array(list(climate_data.values()), dtype=float), index=index)
+    return series[~series.index.duplicated()]
+
+
 def get_rainfall_for_date(selected_date):
     result = get_daily_cumulative_rainfall(selected_date, selected_date + timedelta(days=1))
     if result is None:
         return None
-    for key in result.keys():
-        if key.year == selected_date.year and key.month == selected_date.month and key.day == selected_date.day:
-            return result[key]
-    return None
+    return to_optional(lookup_dates(to_climate_series(result), [selected_date])[0])
 
 
 def get_rainfall_for_dates(date_list):
     prcp_data = get_daily_cumulative_rainfall(date_list[0], date_list[-1] + timedelta(days=1))
     if prcp_data is None:
         return None
-
-    val_list = []
-    selected_dates = set(date_list)
-    for d in prcp_data.keys():
-        if d.date() in selected_dates:
-            val_list.append(prcp_data[d])
-    return val_list
+    values = lookup_dates(to_climate_series(prcp_data), date_list)
+    return values[~np.isnan(values)].tolist()
 
 
 def get_temp_for_date(selected_date):
     result = get_daily_temperature(selected_date, selected_date + timedelta(days=1))
     if result is None:
         return None
-    for key in result.keys():
-        if key.year == selected_date.year and key.month == selected_date.month and key.day == selected_date.day:
-            return result[key]
-    return None
+    return to_optional(lookup_dates(to_climate_series(result), [selected_date])[0])
 
 
 def get_temp_for_dates(date_list):
     temp_data = get_daily_temperature(date_list[0], date_list[-1] + timedelta(days=1))
     if temp_data is None:
         return None
-
-    val_list = []
-    dates = set(temp_data.keys())
-    for d in date_list:
-        if d in dates:
-            val_list.append(temp_data[d])
-        else:
-            val_list.append(None)
-    return val_list
+    return [to_optional(value) for value in lookup_dates(to_climate_series(temp_data), date_list)]